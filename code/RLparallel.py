@@ -1,43 +1,763 @@
 import os
+import sys
+import argparse
+import csv
+import json
+import resource
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Import third party libraries
 import numpy as np
-from mpi4py import MPI
+try:
+    from mpi4py import MPI
+except ImportError:     # Only BACKEND 'numpy' and 'multiprocessing' run without mpi4py
+    from backends import MPI
 import h5py
 
-# Define the number of rows and columns
-NUMROWS = 184320        # TODO: Ideally, for row-major form to exploit caching, NUMROWS must be smaller than NUMCOLS
-NUMCOLS = 3072
+from backends import LocalComm, SerialComm, run_processes
+
+# Define the number of rows and columns. Read from the response file if None, 
+# e.g. 184320 and 3072 for the 44Ti and 511 keV responses.
+NUMROWS = None          # TODO: Ideally, for row-major form to exploit caching, NUMROWS must be smaller than NUMCOLS
+NUMCOLS = None
 
 # Define MPI and iteration misc variables
 MASTER = 0      # Indicates master process
 MAXITER = 50   # Maximum number of iterations
 
+# Back-projection scheme.
+## 'reduce': each rank only keeps its row slab R and computes its share of 
+## R.T @ (d/epsilon). The partial C vectors are summed onto the master with 
+## MPI.Reduce. Halves the response I/O and memory footprint.
+## 'transpose': each rank additionally loads a full-height column slab RT,
+## epsilon is all gatherv-ed and the C slices are gatherv-ed onto the master.
+BACKPROJECTION = 'reduce'
+
+# Storage format of the response matrix.
+## 'dense': dataset "response_matrix"
+## 'csr': group "response_matrix_csr" written by datapreprocessing.py with 
+## response_format='csr'. Mat-vecs scale with the number of nonzeros. 
+## Requires the 'reduce' back-projection scheme.
+RESPONSE_FORMAT = 'dense'
+
+# Stopping criteria evaluated on the master. Set to None to disable.
+TOL_M = None        # Relative change of M, ||M_new - M|| / ||M||
+TOL_LOGL = None     # Absolute change in the Poisson log-likelihood between iterations
+WALLTIME = None     # Wall-clock budget of the iterative segment in seconds
+
+# Partition of the data-space rows and sky-pixel columns over the processes.
+## 'count': equal numbers of rows and columns, the last process also takes 
+## the remainders
+## 'nnz': contiguous ranges with balanced numbers of nonzeros, using the 
+## 'row_nnz' and 'col_nnz' profiles written by datapreprocessing.py
+PARTITION = 'count'
+
+# 2D decomposition. If set to (rows, cols) with rows * cols processes, the 
+# processes form a grid and each holds one block of the response, a range of 
+# rows (split over the grid rows) by a range of columns (split over the grid 
+# columns). M is broadcast down the grid columns, epsilon is all reduced along 
+# the grid rows and C is reduced down the grid columns onto the first grid 
+# row, which updates its ranges of M. Each process only communicates vectors 
+# of length NUMCOLS / cols and NUMROWS / rows, instead of full-length ones. 
+# Replaces BACKPROJECTION and requires a dense response held in memory and 
+# UPDATE_SCHEME = 'rl'. The blocks are contiguous rather than block-cyclic: 
+# the work of a block is fixed and known up front, so PARTITION = 'nnz' 
+# already balances contiguous ranges, and every process keeps reading its 
+# block as one HDF5 hyperslab and exchanging d, epsilon, M and C as single 
+# contiguous ranges in Scatterv/Gatherv.
+PROCESS_GRID = None
+
+# Update scheme of the master-side M update. Both accelerated schemes require 
+# the 'reduce' back-projection scheme.
+## 'rl': plain multiplicative RL update, M = M * C / Rj
+## 'osem': ordered subsets. Each rank splits its row slab into NUM_SUBSETS 
+## contiguous blocks and subset s is the union of every rank's s-th block. One 
+## iteration is NUM_SUBSETS sub-iterations, each using only that subset's rows 
+## and its partial Rj.
+## 'accelerated': over-relaxed RL, M = M + step * delta * M, where step in 
+## [1, ACCELERATION_MAX] maximises the log-likelihood along delta * M while 
+## keeping M non-negative (Siegert et al. 2020). epsilon is updated 
+## incrementally, so no extra mat-vec is required per iteration.
+UPDATE_SCHEME = 'rl'
+NUM_SUBSETS = 4
+ACCELERATION_MAX = 10.0
+
+# Flattened response file in DATA_DIR
+RESPONSE_FILE = 'psr_gal_flattened_511_DC2.h5'
+
+# Datasets deconvolved together against the same loaded response. Each entry 
+# is a pair (signal files, background file) giving d = sum(signals) + bkg. 
+# M, d, bkg, epsilon and C carry one column per dataset, so that the mat-vecs 
+# become mat-mat products and the MPI buffers are len(DATASETS) wide.
+# XXX: Only simulations give access to signal. Eventually, 
+# we will only have observed counts d and a simulated background model.
+DATASETS = [
+    (['data/511_thin_disk_dense.h5'], 'data/albedo_bg_dense.h5'),
+    # (['data/Ti44_CasA_dense.hdf5', 'data/Ti44_G1903_dense.hdf5', 'data/Ti44_SN1987A_dense.hdf5'], 'data/total_bg_dense.hdf5'),
+]
+
+# Out-of-core streaming. If set, the row slab is not held in memory: every 
+# pass over it reads STREAM_CHUNK_ROWS rows at a time from the open HDF5 file, 
+# with the next chunk read on a background thread if STREAM_READ_AHEAD, and 
+# epsilon and the partial C are accumulated chunk by chunk. Peak memory is 
+# bounded by the chunk size. Requires the 'reduce' back-projection scheme.
+STREAM_CHUNK_ROWS = None
+STREAM_READ_AHEAD = True
+
+# Fused projections. In the 'reduce' scheme, every rank computes epsilon and 
+# its partial C in a single pass over its dense row slab (or streamed chunk), 
+# FUSED_BLOCK_BYTES of response rows at a time, about the size of the L2 
+# cache. Each block is back-projected while it is still in cache, so the 
+# response is read from memory once per iteration instead of twice. None 
+# projects the whole slab forward and then back.
+FUSED_BLOCK_BYTES = 1 << 20
+
+# Node-local shared memory. If set, the ranks of a node share a single copy 
+# of M and of the node's rows of the response in MPI-3 shared-memory windows. 
+# Only the first rank of every node reads the response file and receives the 
+# broadcast of M. Requires the ranks of a node to be consecutive, the 'reduce' 
+# back-projection scheme, no streaming and UPDATE_SCHEME 'rl' or 'osem'.
+SHARED_MEMORY = False
+
+# Communication/computation overlap. If set, every rank splits its share of 
+# the projections into PIPELINE_BLOCKS sub-blocks and the collectives become 
+# non-blocking, so that the finished sub-blocks are communicated while the 
+# next ones are computed.
+## 'reduce': M is received with Ibcast one block of pixels at a time during 
+## the forward projection, and each block of the partial C is Ireduce-d as 
+## soon as it is back-projected. The master updates each block of M once its 
+## reduction is complete.
+## 'transpose': the epsilon sub-blocks are Iallgatherv-ed during the forward 
+## projection and the C sub-blocks are Igatherv-ed during the back projection.
+## Requires a dense response held in memory and UPDATE_SCHEME 'rl' or 'osem'.
+PIPELINE_BLOCKS = None
+
+# Hybrid MPI + threads. THREADS_PER_RANK sets the number of threads every 
+# rank uses for its projections, e.g. 4 ranks per node with 8 threads each 
+# instead of 32 ranks, so that fewer ranks take part in every collective. 
+# 'auto' divides the cores of a node by its ranks. None leaves the threading 
+# of the BLAS library to the environment, which oversubscribes the cores if 
+# every rank of a full node starts its own BLAS threads.
+## 'blas': every product runs on THREADS_PER_RANK BLAS threads. Requires 
+## threadpoolctl, otherwise launch with OMP_NUM_THREADS=THREADS_PER_RANK.
+## 'pool': BLAS is limited to one thread and the rows of each slab are split 
+## into THREADS_PER_RANK blocks that are projected on a ThreadPoolExecutor.
+# With PIN_THREADS, the threads of every rank are pinned to their own 
+# THREADS_PER_RANK cores of the node (Linux only).
+THREADS_PER_RANK = None
+THREAD_BACKEND = 'blas'
+PIN_THREADS = False
+THREAD_POOL = None      # Filled by main() for THREAD_BACKEND 'pool'
+THREAD_COUNT = 1
+
+# Multi-resolution. RESOLUTION_LEVELS lists (response file, iterations) of 
+# coarser HEALPix levels, coarsest first, written by 
+# DowngradedResponse_FilesCheck in datapreprocessing.py, e.g. 
+# [('psr_gal_flattened_511_DC2_nside4.h5', 50), ('psr_gal_flattened_511_DC2_nside8.h5', 50)]. 
+# They are deconvolved before RESPONSE_FILE, each from the converged M of 
+# the previous level, copied to the child pixels, so that the expensive 
+# full-resolution iterations start from the located flux instead of the 
+# uniform guess. OUTPUT_FILE, COMPARE_WITH, RUN_REPORT and checkpoints only 
+# apply to the final level.
+RESOLUTION_LEVELS = []
+
+# Ensemble. With ENSEMBLE_SIZE set, the deconvolution is repeated for that 
+# many Poisson realizations of d for per-pixel uncertainty maps. 
+# COMM_WORLD is split into groups of ENSEMBLE_GROUP_SIZE processes (the 
+# fastest size of a single solve, see outputs/speedup_expanse.txt), which 
+# solve their share of the realizations concurrently. Every process draws 
+# the counts of its own rows from a generator seeded with ENSEMBLE_SEED, the 
+# realization and its first row, so a run is reproducible for a given group 
+# size. The mean and variance of M over the realizations are written to the 
+# HDF5 file ENSEMBLE_OUTPUT (datasets "mean" and "variance"). OUTPUT_FILE, 
+# COMPARE_WITH, RUN_REPORT and checkpoints are not used. Requires 'mpi'.
+ENSEMBLE_SIZE = None
+ENSEMBLE_GROUP_SIZE = 8
+ENSEMBLE_SEED = 0
+ENSEMBLE_OUTPUT = None
+
+# Active set. Rows without counts in any dataset (d_i = 0) do not contribute 
+# to d / epsilon, so with ACTIVE_SET every rank drops them from its slab and 
+# the rows with counts are balanced over the ranks instead. Every 
+# ACTIVE_SET_EVERY iterations, a full iteration re-checks the sky pixels: 
+# pixels below ACTIVE_SET_THRESHOLD times the peak of M in every dataset, 
+# and not growing, are frozen until the next check. Their contribution to 
+# epsilon is added to the background and their columns are skipped. 
+# Requires an in-memory response, BACKPROJECTION 'reduce', UPDATE_SCHEME 
+# 'rl' and no SHARED_MEMORY, PIPELINE_BLOCKS or PROCESS_GRID.
+ACTIVE_SET = False
+ACTIVE_SET_THRESHOLD = 1e-6
+ACTIVE_SET_EVERY = 10
+
+# Execution backend. All backends run the same solver (main()) and give the 
+# same M for the same number of processes, up to the summation order of the 
+# reductions.
+## 'mpi': the processes launched by mpiexec. Requires mpi4py and h5py with 
+## parallel HDF5 (driver 'mpio').
+## 'numpy': a single process without MPI, e.g. on a laptop or for small 
+## problems where the MPI startup dominates.
+## 'multiprocessing': NUM_PROCESSES processes of this node (default: one per 
+## core) that exchange the vectors through multiprocessing queues. Does not 
+## need MPI either. SHARED_MEMORY, PIPELINE_BLOCKS, PROCESS_GRID and 
+## SERVICE_SPOOL require 'mpi'.
+BACKEND = 'mpi'
+NUM_PROCESSES = None
+
+# Checkpointing. Every CHECKPOINT_EVERY iterations, and when the loop ends, 
+# the master writes M, the iteration counter and the log-likelihood to the 
+# HDF5 file CHECKPOINT_FILE on a background thread. With RESUME, the run 
+# continues from that checkpoint if it exists. WARM_START seeds the initial 
+# sky model from a previous result instead: a CSV file such as 
+# outputs/SDSC/ConvergedM44Ti_n8.csv or an HDF5 file with dataset "M".
+CHECKPOINT_FILE = None
+CHECKPOINT_EVERY = 10
+RESUME = False
+WARM_START = None
+
+# Working precision of the response. With 'float32', the response is read 
+# (converted by HDF5 if stored as float64, see datapreprocessing.py) and 
+# multiplied in single precision, halving its memory and I/O, and M is 
+# broadcast in single precision. The products are summed in float64: 
+# epsilon over blocks of ACCUMULATION_COLS columns and the back projection C 
+# over blocks of ACCUMULATION_ROWS rows of the response. Rj and the update 
+# of M stay in float64.
+PRECISION = 'float64'
+ACCUMULATION_ROWS = 4096
+ACCUMULATION_COLS = 256
+
+# Comparison of the converged M against a reference result, e.g. of a 
+# float64 run such as outputs/SDSC/ConvergedM44Ti_n8.csv (CSV or HDF5 file 
+# with dataset "M"). The master reports the largest deviation relative to 
+# the peak of each map and whether it is within COMPARE_RTOL.
+COMPARE_WITH = None
+COMPARE_RTOL = 1e-3
+
+# Per-phase timing and communication report. Set to a path without suffix, 
+# e.g. FILE_DIR / 'outputs/run_report', to write <path>.json (summary over 
+# ranks) and <path>.csv (one record per rank, iteration and phase). None 
+# disables the instrumentation.
+RUN_REPORT = None
+
+# Output. If set, the master writes the converged M to this file with 
+# np.savetxt (one column per dataset).
+OUTPUT_FILE = None
+
+# Persistent service. If SERVICE_SPOOL is set to a directory, running this 
+# script loads the response once and then runs every <name>.json job file 
+# dropped into the directory, keeping the in-memory response slabs and Rj 
+# resident between the jobs (not with STREAM_CHUNK_ROWS or SHARED_MEMORY). A 
+# job file holds settings from JOB_SETTINGS, e.g.
+# {"DATASETS": [[["data/Ti44_CasA_dense.hdf5"], "data/total_bg_dense.hdf5"]], 
+#  "MAXITER": 100, "OUTPUT_FILE": "outputs/ConvergedM_CasA.csv"}
+# and all other settings are reset to the defaults of this file. The job 
+# file is renamed to <name>.done, or to <name>.failed with the reason in 
+# <name>.log. The settings and files of a job are checked before it starts; 
+# a job that fails while running aborts the service (MPI_Abort), since the 
+# processes cannot agree on the next job. The master checks for new jobs every SERVICE_POLL_SECONDS; a 
+# file named STOP in the directory shuts the service down.
+SERVICE_SPOOL = None
+SERVICE_POLL_SECONDS = 2.0
+JOB_SETTINGS = ['DATASETS', 'MAXITER', 'TOL_M', 'TOL_LOGL', 'WALLTIME', 'UPDATE_SCHEME', 'NUM_SUBSETS', 'ACCELERATION_MAX', 
+                'WARM_START', 'CHECKPOINT_FILE', 'CHECKPOINT_EVERY', 'RESUME', 'RUN_REPORT', 'COMPARE_WITH', 'COMPARE_RTOL', 
+                'OUTPUT_FILE']
+RESIDENT_RESPONSE = None        # Filled by serve()
+
+# Settings that cannot be changed through configure()
+NOT_CONFIGURABLE = ('MPI', 'MASTER', 'FILE_DIR', 'JOB_SETTINGS', 'RESIDENT_RESPONSE', 'THREAD_POOL', 'THREAD_COUNT', 'SETTING_TYPES', 
+                    'SETTING_MINIMUMS', 'NOT_CONFIGURABLE')
+
+# Types of the settings that may be None, checked by configure() and the 
+# service jobs. Every other setting takes the type of its default.
+SETTING_TYPES = {'NUMROWS': int, 'NUMCOLS': int, 'TOL_M': float, 'TOL_LOGL': float, 'WALLTIME': float, 'STREAM_CHUNK_ROWS': int, 
+                 'FUSED_BLOCK_BYTES': int, 'PIPELINE_BLOCKS': int, 'THREADS_PER_RANK': int, 'ENSEMBLE_SIZE': int, 
+                 'NUM_PROCESSES': int, 'PROCESS_GRID': tuple, 'WARM_START': str, 'COMPARE_WITH': str, 'CHECKPOINT_FILE': str, 
+                 'OUTPUT_FILE': str, 'RUN_REPORT': str, 'ENSEMBLE_OUTPUT': str, 'SERVICE_SPOOL': str}
+
+# Smallest values of the counts (and of every entry of PROCESS_GRID)
+SETTING_MINIMUMS = {'NUMROWS': 1, 'NUMCOLS': 1, 'MAXITER': 1, 'NUM_SUBSETS': 1, 'STREAM_CHUNK_ROWS': 1, 'FUSED_BLOCK_BYTES': 1, 
+                    'PIPELINE_BLOCKS': 1, 'PROCESS_GRID': 1, 'THREADS_PER_RANK': 1, 'ENSEMBLE_SIZE': 1, 'ENSEMBLE_GROUP_SIZE': 1, 
+                    'ACTIVE_SET_EVERY': 1, 'NUM_PROCESSES': 1, 'CHECKPOINT_EVERY': 1, 'ACCUMULATION_ROWS': 1, 'ACCUMULATION_COLS': 1, 
+                    'ACCELERATION_MAX': 1.0, 'TOL_M': 0.0, 'TOL_LOGL': 0.0, 'WALLTIME': 0.0, 'ACTIVE_SET_THRESHOLD': 0.0, 
+                    'COMPARE_RTOL': 0.0, 'SERVICE_POLL_SECONDS': 0.0}
+
 FILE_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 BASE_DIR = Path('/Users/penguin/Documents/Grad School/Research/COSI/COSIpy/docs/tutorials/44Ti/')
 DATA_DIR = Path('/Users/penguin/Documents/Grad School/Research/COSI/COSIpy/docs/tutorials/data/')
 
+'''
+Parallel HDF5 access for MPI communicators. The processes of the local 
+backends open the file independently.
+'''
+def file_access(comm):
+    return {} if isinstance(comm, LocalComm) else {'driver': 'mpio', 'comm': comm}
+
 '''
 Response matrix
 '''
-def load_response_matrix(comm, start_row, end_row, filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
-    with h5py.File(DATA_DIR / filename, "r", driver="mpio", comm=comm) as f1:
+def load_response_matrix(comm, start_row, end_row, dtype=np.float64, filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
+    with h5py.File(DATA_DIR / filename, "r", **file_access(comm)) as f1:
         # Assuming the dataset name is "response_matrix"
         dataset = f1["response_matrix"]
-        R = dataset[start_row:end_row, :]
+        R = dataset.astype(dtype)[start_row:end_row, :]
+    return R
+
+'''
+Response matrix in CSR format. Returns the row slab as a tuple (rows, cols, 
+vals, numrows) of local row indices, column indices and nonzero values.
+'''
+def load_sparse_response_matrix(comm, start_row, end_row, dtype=np.float64, filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
+    with h5py.File(DATA_DIR / filename, "r", **file_access(comm)) as f1:
+        R = read_sparse_rows(f1["response_matrix_csr"], start_row, end_row, dtype)
     return R
 
+'''
+Rows start_row:end_row of an open "response_matrix_csr" group
+'''
+def read_sparse_rows(group, start_row, end_row, dtype=np.float64):
+    indptr = group["indptr"][start_row:end_row+1]
+    cols = group["indices"][indptr[0]:indptr[-1]]
+    vals = group["data"].astype(dtype)[indptr[0]:indptr[-1]]
+    rows = np.repeat(np.arange(end_row - start_row, dtype=np.int32), np.diff(indptr))
+    return rows, cols, vals, end_row - start_row
+
+'''
+Row slab that stays on disk. Every pass reads it in chunks of chunk_rows rows 
+(dense or CSR) from the open response file, optionally reading the next 
+chunk on a background thread while the current one is processed.
+'''
+class StreamedSlab:
+    def __init__(self, response_file, start_row, end_row, chunk_rows, read_ahead=True, sparse=False, dtype=np.float64):
+        self.response_file = response_file
+        self.sparse = sparse
+        self.dtype = dtype
+        self.start_row = start_row
+        self.end_row = end_row
+        self.chunk_rows = chunk_rows
+        self.read_ahead = read_ahead
+
+    def read(self, lo, hi):
+        if self.sparse:
+            return read_sparse_rows(self.response_file["response_matrix_csr"], self.start_row + lo, self.start_row + hi, self.dtype)
+        return self.response_file["response_matrix"].astype(self.dtype)[self.start_row + lo:self.start_row + hi, :]
+
+    def chunks(self):
+        # Yields (lo, hi, R_chunk) in local row indices
+        edges = list(range(0, self.end_row - self.start_row, self.chunk_rows)) + [self.end_row - self.start_row]
+        bounds = list(zip(edges[:-1], edges[1:]))
+        if not self.read_ahead:
+            for lo, hi in bounds:
+                yield lo, hi, self.read(lo, hi)
+            return
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self.read, *bounds[0]) if bounds else None
+            for i, (lo, hi) in enumerate(bounds):
+                R_chunk = future.result()
+                if i + 1 < len(bounds):
+                    future = pool.submit(self.read, *bounds[i + 1])
+                yield lo, hi, R_chunk
+
+'''
+Open the response file for streaming the row slab start_row:end_row. The 
+file stays open until the returned slab's file is closed (collectively).
+'''
+def open_streamed_response_matrix(comm, start_row, end_row, chunk_rows, read_ahead=True, sparse=False, dtype=np.float64, 
+                                  filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
+    f1 = h5py.File(DATA_DIR / filename, "r", **file_access(comm))
+    return StreamedSlab(f1, start_row, end_row, chunk_rows, read_ahead, sparse, dtype)
+
+'''
+Rows and columns (boolean masks, None for all) of a dense or CSR row slab. 
+A dense slab is compacted to the selected columns. A CSR slab keeps its 
+column indices, so only the nonzeros of the selected columns remain.
+'''
+def restrict_slab(R, rows=None, cols=None):
+    if isinstance(R, np.ndarray):
+        if rows is not None:
+            R = R[rows]
+        if cols is not None:
+            R = np.ascontiguousarray(R[:, cols])
+        return R
+    row_indices, col_indices, vals, numrows = R
+    keep = np.ones(vals.size, dtype=bool)
+    if rows is not None:
+        keep &= rows[row_indices]
+    if cols is not None:
+        keep &= cols[col_indices]
+    row_indices, col_indices, vals = row_indices[keep], col_indices[keep], vals[keep]
+    if rows is not None:
+        row_indices = (np.cumsum(rows) - 1)[row_indices]
+        numrows = int(rows.sum())
+    return row_indices, col_indices, vals, numrows
+
+'''
+Rows lo:hi of a dense, CSR or streamed row slab (a view for dense slabs)
+'''
+def slice_rows(R, lo, hi):
+    if isinstance(R, np.ndarray):
+        return R[lo:hi]
+    if isinstance(R, StreamedSlab):
+        return StreamedSlab(R.response_file, R.start_row + lo, R.start_row + hi, R.chunk_rows, R.read_ahead, R.sparse, R.dtype)
+    rows, cols, vals, numrows = R
+    a, b = np.searchsorted(rows, [lo, hi])
+    return rows[a:b] - lo, cols[a:b], vals[a:b], hi - lo
+
+'''
+Array in an MPI-3 shared-memory window of the node communicator. The memory 
+is allocated by the first rank of the node and every rank of the node gets a 
+view of it. The window must be freed (collectively) after its last use.
+'''
+def allocate_shared_array(node_comm, shape, dtype=np.float64):
+    itemsize = np.dtype(dtype).itemsize
+    nbytes = max(int(np.prod(shape)), 1) * itemsize if node_comm.Get_rank() == 0 else 0
+    win = MPI.Win.Allocate_shared(nbytes, itemsize, comm=node_comm)
+    buf, itemsize = win.Shared_query(0)
+    return win, np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+
+'''
+Copy of an array of the first rank of the node in node shared memory. The 
+array argument is ignored on all other ranks.
+'''
+def share_array(node_comm, array):
+    shape, dtype = node_comm.bcast((array.shape, array.dtype) if node_comm.Get_rank() == 0 else None, root=0)
+    win, shared = allocate_shared_array(node_comm, shape, dtype)
+    if node_comm.Get_rank() == 0:
+        shared[...] = array
+    node_comm.Barrier()
+    return win, shared
+
+'''
+Thread setup of a rank for the hybrid mode. Resolves THREADS_PER_RANK, pins 
+the existing and future threads of the rank to its own cores of the node 
+with PIN_THREADS, and limits the BLAS threads to THREADS_PER_RANK ('blas') 
+or to one ('pool'). Returns the number of threads, the BLAS thread limit 
+(None if threadpoolctl is not installed), the pinned cores (or None) and 
+the number of ranks on the node.
+'''
+def setup_threads(comm):
+    host_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.Get_rank())
+    local_rank, local_size = host_comm.Get_rank(), host_comm.Get_size()
+    host_comm.Free()
+    numcores = os.cpu_count()
+    threads = max(1, numcores // local_size) if THREADS_PER_RANK == 'auto' else int(THREADS_PER_RANK)
+
+    cores = None
+    if PIN_THREADS:
+        if not hasattr(os, 'sched_setaffinity'):
+            raise ValueError('PIN_THREADS requires os.sched_setaffinity (Linux).')
+        cores = [(local_rank * threads + i) % numcores for i in range(threads)]
+        for thread_id in os.listdir('/proc/self/task'):
+            os.sched_setaffinity(int(thread_id), cores)
+
+    blas_threads = threads if THREAD_BACKEND == 'blas' else 1
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=blas_threads, user_api='blas')
+    except ImportError:
+        blas_threads = None
+    return threads, blas_threads, cores, local_size
+
+'''
+Row ranges of a dense or CSR slab for the THREAD_POOL workers
+'''
+def thread_blocks(R):
+    numrows = R.shape[0] if isinstance(R, np.ndarray) else R[3]
+    bounds = np.linspace(0, numrows, THREAD_COUNT + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+'''
+Forward projection R @ M of a dense, CSR or streamed row slab. M is a vector 
+or has one column per dataset. A float32 slab is multiplied in float32, 
+ACCUMULATION_COLS columns at a time, and the blocks summed in float64. With THREAD_POOL, the row blocks of a dense 
+or CSR slab (or of each streamed chunk) are projected on its threads.
+'''
+def forward_project(R, M, threaded=True):
+    if threaded and THREAD_POOL is not None and not isinstance(R, StreamedSlab):
+        return np.concatenate(list(THREAD_POOL.map(lambda block: forward_project(slice_rows(R, *block), M, threaded=False), 
+                                                   thread_blocks(R))))
+    if isinstance(R, np.ndarray) and R.dtype == np.float64:
+        return np.dot(R, M)
+    if isinstance(R, np.ndarray):
+        M = M.astype(R.dtype, copy=False)
+        epsilon = np.zeros((R.shape[0],) + M.shape[1:])
+        for lo in range(0, R.shape[1], ACCUMULATION_COLS):
+            epsilon += np.dot(R[:, lo:lo + ACCUMULATION_COLS], M[lo:lo + ACCUMULATION_COLS])
+        return epsilon
+    if isinstance(R, StreamedSlab):
+        epsilon = np.empty((R.end_row - R.start_row,) + M.shape[1:])
+        for lo, hi, R_chunk in R.chunks():
+            epsilon[lo:hi] = forward_project(R_chunk, M)
+        return epsilon
+    rows, cols, vals, numrows = R
+    if M.ndim == 1:
+        return np.bincount(rows, weights=vals * M[cols], minlength=numrows)
+    return np.stack([np.bincount(rows, weights=vals * M[cols, k], minlength=numrows) for k in range(M.shape[1])], axis=1)
+
+'''
+Back projection R.T @ y of a dense, CSR or streamed row slab. y is a vector 
+or has one column per dataset. A float32 slab is multiplied in float32, 
+ACCUMULATION_ROWS rows at a time, and the blocks summed in float64. With 
+THREAD_POOL, the row blocks are back-projected on its threads and summed.
+'''
+def back_project(R, y, threaded=True):
+    if threaded and THREAD_POOL is not None and not isinstance(R, StreamedSlab):
+        return sum(THREAD_POOL.map(lambda block: back_project(slice_rows(R, *block), y[block[0]:block[1]], threaded=False), 
+                                   thread_blocks(R)))
+    if isinstance(R, np.ndarray) and R.dtype == np.float64:
+        return np.dot(R.T, y)
+    if isinstance(R, np.ndarray):
+        y = y.astype(R.dtype)
+        C = np.zeros(R.shape[1:] + y.shape[1:])
+        for lo in range(0, R.shape[0], ACCUMULATION_ROWS):
+            C += np.dot(R[lo:lo + ACCUMULATION_ROWS].T, y[lo:lo + ACCUMULATION_ROWS])
+        return C
+    if isinstance(R, StreamedSlab):
+        C = np.zeros((NUMCOLS,) + y.shape[1:])
+        for lo, hi, R_chunk in R.chunks():
+            C += back_project(R_chunk, y[lo:hi])
+        return C
+    rows, cols, vals, numrows = R
+    if y.ndim == 1:
+        return np.bincount(cols, weights=vals * y[rows], minlength=NUMCOLS)
+    return np.stack([np.bincount(cols, weights=vals * y[rows, k], minlength=NUMCOLS) for k in range(y.shape[1])], axis=1)
+
+'''
+epsilon = R @ M + offset and the back projection C = R.T @ (d / epsilon) in 
+a single pass over the row slab: chunk by chunk for streamed slabs and in 
+cache-sized blocks of FUSED_BLOCK_BYTES for dense slabs. A CSR slab is only 
+read through its nonzeros and is projected in one block. With THREAD_POOL, 
+every thread projects both ways on its own block of rows.
+'''
+def forward_back_project(R, M, offset, d, threaded=True):
+    if threaded and THREAD_POOL is not None and not isinstance(R, StreamedSlab):
+        blocks = thread_blocks(R)
+        results = list(THREAD_POOL.map(lambda block: forward_back_project(slice_rows(R, *block), M, offset[block[0]:block[1]], 
+                                                                          d[block[0]:block[1]], threaded=False), blocks))
+        return np.concatenate([epsilon for epsilon, C in results]), sum(C for epsilon, C in results)
+    if isinstance(R, StreamedSlab):
+        epsilon = np.empty((R.end_row - R.start_row,) + M.shape[1:])
+        C = np.zeros((NUMCOLS,) + M.shape[1:])
+        for lo, hi, R_chunk in R.chunks():
+            epsilon[lo:hi], C_chunk = forward_back_project(R_chunk, M, offset[lo:hi], d[lo:hi])
+            C += C_chunk
+        return epsilon, C
+    if not isinstance(R, np.ndarray) or FUSED_BLOCK_BYTES is None:
+        epsilon = forward_project(R, M, threaded=False) + offset
+        return epsilon, back_project(R, d / epsilon, threaded=False)
+    block_rows = max(1, FUSED_BLOCK_BYTES // max(1, R.shape[1] * R.itemsize))
+    epsilon = np.empty((R.shape[0],) + M.shape[1:])
+    C = np.zeros((R.shape[1],) + M.shape[1:])
+    for lo in range(0, R.shape[0], block_rows):
+        R_block = R[lo:lo + block_rows]
+        epsilon[lo:lo + block_rows] = forward_project(R_block, M, threaded=False) + offset[lo:lo + block_rows]
+        C += back_project(R_block, d[lo:lo + block_rows] / epsilon[lo:lo + block_rows], threaded=False)
+    return epsilon, C
+
+'''
+Rounds of a pipelined (all)gatherv. Every rank's share of counts[r] rows at 
+displacements[r] is split into numblocks sub-blocks and round j moves the 
+j-th sub-block of every rank. Returns for every round this rank's local 
+(lo, hi) and the recvcounts and displacements of K values per row.
+'''
+def pipeline_rounds(counts, displacements, rank, numblocks, K):
+    edges = np.array([np.linspace(0, count, numblocks + 1).astype(int) for count in counts])
+    rounds = []
+    for j in range(numblocks):
+        lo = edges[:, j]
+        hi = edges[:, j + 1]
+        rounds.append(((lo[rank], hi[rank]), (hi - lo) * K, (displacements + lo) * K))
+    return rounds
+
+'''
+Relative RL update C / Rj - 1. Pixels without sensitivity (Rj = 0), e.g. in 
+an OSEM subset whose rows do not see them, are left unchanged.
+'''
+def rl_delta(C, Rj):
+    return np.divide(C, Rj, out=np.ones_like(C), where=Rj > 0) - 1
+
+'''
+Poisson log-likelihood of the data given the expectation epsilon, up to 
+the constant -sum(log(d!)). Summed over the given (slice of) data space, 
+separately for each dataset column.
+'''
+def poisson_log_likelihood(d, epsilon):
+    return np.sum(d * np.log(epsilon) - epsilon, axis=0)
+
+'''
+Step size maximising the Poisson log-likelihood along epsilon + step * r for 
+step in [1, step_max], one per dataset column. Safeguarded Newton iterations 
+on the derivative, whose sums over data space are all reduced, so every 
+process returns the same steps.
+'''
+def line_search(comm, d, epsilon, r, step_max, maxiter=10, tol=1e-3):
+    def derivatives(step):
+        ratio = r / (epsilon + step * r)
+        local = np.array([np.sum(d * ratio - r, axis=0), -np.sum(d * ratio**2, axis=0)])
+        comm.Allreduce(MPI.IN_PLACE, [local, MPI.DOUBLE], op=MPI.SUM)
+        return local
+
+    lo = np.ones_like(step_max)
+    hi = step_max.copy()
+    step = lo.copy()
+    g, gp = derivatives(step)
+    active = (g > 0) & (hi > lo)                        # Otherwise the plain RL step is already optimal
+    for i in range(maxiter):
+        if not np.any(active):
+            break
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = np.where(gp < 0, step - g / gp, hi)
+        step_new = np.where((lo < newton) & (newton < hi), newton, 0.5 * (lo + hi))
+        step_new = np.where(active, step_new, step)
+        g, gp = derivatives(step_new)
+        lo = np.where(active & (g > 0), step_new, lo)
+        hi = np.where(active & (g <= 0), step_new, hi)
+        active &= np.abs(step_new - step) >= tol * step
+        step = step_new
+    return step
+
+'''
+Per-phase wall-clock timer and communication counter. Each rank records 
+(iteration, phase, seconds, bytes) tuples, where bytes is the size of the 
+buffer the rank passes to the collective (or reads from disk) and iteration 
+-1 is the setup. The phase body may overwrite stats['bytes'].
+'''
+class PhaseTimer:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.iteration = -1
+        self.records = []
+        self.start = MPI.Wtime()
+
+    @contextmanager
+    def phase(self, name, nbytes=0):
+        stats = {'bytes': nbytes}
+        if not self.enabled:
+            yield stats
+            return
+        start = MPI.Wtime()
+        try:
+            yield stats
+        finally:
+            self.records.append((self.iteration, name, MPI.Wtime() - start, int(stats['bytes'])))
+
+'''
+Peak resident set size of this process in MB
+'''
+def peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024      # Bytes on macOS, kB on Linux
+
+'''
+Gather the timing records of all ranks onto master and write the run report 
+<filename>.csv and <filename>.json. Must be called by all processes.
+'''
+def write_run_report(comm, timer, filename, settings):
+    records = comm.gather(timer.records, root=MASTER)
+    rss = comm.gather(peak_rss_mb(), root=MASTER)
+    elapsed = comm.gather(MPI.Wtime() - timer.start, root=MASTER)
+    if comm.Get_rank() != MASTER:
+        return
+
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    with open(filename.with_suffix('.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'iteration', 'phase', 'seconds', 'bytes'])
+        for rank, rank_records in enumerate(records):
+            writer.writerows((rank,) + record for record in rank_records)
+
+    # Per-phase totals of each rank, summarised over ranks. The imbalance 
+    # max/mean of the compute phases shows up as waiting time in the 
+    # following collective.
+    phases = {}
+    for rank, rank_records in enumerate(records):
+        for iteration, name, seconds, nbytes in rank_records:
+            phase = phases.setdefault(name, {'seconds': np.zeros(len(records)), 'bytes': np.zeros(len(records)), 'calls': np.zeros(len(records), dtype=int)})
+            phase['seconds'][rank] += seconds
+            phase['bytes'][rank] += nbytes
+            phase['calls'][rank] += 1
+    iterations = max((record[0] for rank_records in records for record in rank_records), default=-1) + 1
+    summary = {
+        'numtasks': comm.Get_size(),
+        'iterations': iterations,
+        'elapsed_seconds': max(elapsed),
+        'settings': settings,
+        'peak_rss_mb': {'per_rank': rss, 'max': max(rss), 'total': sum(rss)},
+        'phases': {name: {
+            'seconds_min': phase['seconds'].min(),
+            'seconds_mean': phase['seconds'].mean(),
+            'seconds_max': phase['seconds'].max(),
+            'imbalance': phase['seconds'].max() / phase['seconds'].mean() if phase['seconds'].mean() > 0 else 1.,
+            'bytes_total': phase['bytes'].sum(),
+            'calls_max': int(phase['calls'].max()),
+        } for name, phase in phases.items()},
+    }
+    with open(filename.with_suffix('.json'), 'w') as f:
+        json.dump(summary, f, indent=2, default=float)
+    print(f'Run report written to {filename}.json')
+
+'''
+Nonzero profiles of the response along the rows and columns, or None if 
+the flattened response file predates them
+'''
+def load_cost_profiles(filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
+    with h5py.File(DATA_DIR / filename, "r") as f1:
+        if "row_nnz" not in f1 or "col_nnz" not in f1:
+            return None
+        return f1["row_nnz"][:], f1["col_nnz"][:]
+
+'''
+Contiguous ranges of balanced total cost. Every row costs at least one unit 
+on top of its profile, so that empty rows are still spread. Returns the 
+counts and displacements of the numparts ranges.
+'''
+def balanced_partition(cost, numparts):
+    cumulative = np.concatenate(([0.], np.cumsum(cost + 1., dtype=np.float64)))
+    targets = cumulative[-1] * np.arange(1, numparts) / numparts
+    edges = np.searchsorted(cumulative, targets)
+    edges -= (targets - cumulative[edges - 1]) < (cumulative[edges] - targets)      # Nearer edge
+    edges = np.concatenate(([0], edges, [len(cost)]))
+    return np.diff(edges), edges[:-1]
+
+'''
+Largest over mean total cost per process of a partition
+'''
+def partition_imbalance(cost, counts, displacements):
+    cumulative = np.concatenate(([0], np.cumsum(cost)))
+    per_rank = cumulative[displacements + counts] - cumulative[displacements]
+    return per_rank.max() / per_rank.mean() if per_rank.mean() > 0 else 1.
+
 '''
 Response matrix transpose
 '''
-def load_response_matrix_transpose(comm, start_col, end_col, filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
-    with h5py.File(DATA_DIR / filename, "r", driver="mpio", comm=comm) as f1:
+def load_response_matrix_transpose(comm, start_col, end_col, dtype=np.float64, filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
+    with h5py.File(DATA_DIR / filename, "r", **file_access(comm)) as f1:
         # Assuming the dataset name is "response_matrix"
         dataset = f1["response_matrix"]
-        RT = dataset[:, start_col:end_col]
+        RT = dataset.astype(dtype)[:, start_col:end_col]
     return RT
 
+'''
+Response matrix block of the 2D decomposition
+'''
+def load_response_block(comm, start_row, end_row, start_col, end_col, dtype=np.float64, filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
+    with h5py.File(DATA_DIR / filename, "r", **file_access(comm)) as f1:
+        # Assuming the dataset name is "response_matrix"
+        dataset = f1["response_matrix"]
+        R = dataset.astype(dtype)[start_row:end_row, start_col:end_col]
+    return R
+
+'''
+Shape of the flattened response matrix, dense or CSR
+'''
+def read_response_shape(filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
+    with h5py.File(DATA_DIR / filename, "r") as f1:
+        if "response_matrix" in f1:
+            return f1["response_matrix"].shape
+        return tuple(int(n) for n in f1["response_matrix_csr"].attrs["shape"])
+
 '''
 Response matrix summed along axis=i
 '''
@@ -49,12 +769,80 @@ def load_axis0_summed_response_matrix(filename='psr_gal_flattened_Ti44_E_1150_11
     return Rj
 
 '''
-Sky model
+Sky model. Uniform initial guess, or a warm start from a previous result 
+stored as CSV (np.savetxt) or as dataset "M" of an HDF5 file, or given as 
+an array (e.g. upsampled from a coarser resolution level).
 '''
-def initial_sky_model():
-    M0 = np.ones(NUMCOLS, dtype=np.float64) * 1e-4                 # Initial guess according to image_deconvolution.py
+def read_sky_model(filename):
+    if Path(filename).suffix in ('.h5', '.hdf5'):
+        with h5py.File(filename, "r") as f:
+            return f["M"][:]
+    return np.loadtxt(filename, dtype=np.float64)
+
+def initial_sky_model(filename=None):
+    if filename is None:
+        M0 = np.ones(NUMCOLS, dtype=np.float64) * 1e-4                 # Initial guess according to image_deconvolution.py
+    elif isinstance(filename, np.ndarray):
+        M0 = filename
+    else:
+        M0 = read_sky_model(filename)
+    if M0.shape[0] != NUMCOLS:
+        raise ValueError(f'Sky model in {filename} has {M0.shape[0]} pixels, expected NUMCOLS = {NUMCOLS}.')
     return M0
 
+'''
+Pixel of a downgraded response file ('parent_pixel') for every pixel of the 
+full-resolution response, or None for a full-resolution file
+'''
+def load_parent_pixels(filename='psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
+    with h5py.File(DATA_DIR / filename, "r") as f1:
+        return f1["parent_pixel"][:] if "parent_pixel" in f1 else None
+
+'''
+Upsample the sky model M of a coarse level to a finer one by copying every 
+pixel to its children. The levels are given by their parent pixels of the 
+full-resolution pixels (None for the full resolution).
+'''
+def upsample_sky_model(M, coarse_parent, fine_parent):
+    if fine_parent is None:
+        fine_parent = np.arange(len(coarse_parent))
+    M_fine = np.empty((fine_parent.max() + 1,) + M.shape[1:])
+    M_fine[fine_parent] = M[coarse_parent]
+    return M_fine
+
+'''
+Largest deviation of M from a reference sky model (CSV or HDF5, see 
+initial_sky_model) relative to the peak of the reference, per dataset
+'''
+def compare_sky_models(M, filename):
+    M_ref = initial_sky_model(filename)
+    if M_ref.ndim == 1:
+        M_ref = M_ref[:, np.newaxis]
+    return np.max(np.abs(M - M_ref), axis=0) / np.max(np.abs(M_ref), axis=0)
+
+'''
+Checkpoint of the solver state. Written to a temporary file that replaces 
+the previous checkpoint only once complete, so an interrupted write never 
+leaves a corrupt checkpoint behind.
+'''
+def save_checkpoint(filename, M, iteration, logL=None):
+    filename = Path(filename)
+    tmp_filename = filename.with_name(filename.name + '.tmp')
+    with h5py.File(tmp_filename, "w") as f:
+        f.create_dataset("M", data=M)
+        f.attrs["iteration"] = iteration
+        f.attrs["UPDATE_SCHEME"] = UPDATE_SCHEME
+        if logL is not None:
+            f.create_dataset("logL", data=logL)
+    os.replace(tmp_filename, filename)
+
+def load_checkpoint(filename):
+    with h5py.File(filename, "r") as f:
+        M = f["M"][:]
+        iteration = int(f.attrs["iteration"])
+        logL = f["logL"][:] if "logL" in f else None
+    return M, iteration, logL
+
 '''
 Background model
 '''
@@ -71,35 +859,247 @@ def load_signal_counts(filename='data/Ti44_CasA_x50_dense.hdf5'):
         signal = hf_signal['contents'][:]
     return signal
 
-def main():
-    # Set up MPI
-    comm = MPI.COMM_WORLD
+def main(finalize=True, comm=None, realization=None):
+    global NUMROWS, NUMCOLS, THREAD_POOL, THREAD_COUNT
+
+    # Set up MPI, or the communicator of a local backend
+    comm = MPI.COMM_WORLD if comm is None else comm
     numtasks = comm.Get_size()
     taskid = comm.Get_rank()
+    timer = PhaseTimer(enabled=RUN_REPORT is not None)
+    if isinstance(comm, LocalComm) and (SHARED_MEMORY or PIPELINE_BLOCKS is not None or PROCESS_GRID is not None):
+        raise ValueError("SHARED_MEMORY, PIPELINE_BLOCKS and PROCESS_GRID require BACKEND = 'mpi'.")
+
+    # Shape of the response matrix, read by master
+    shape = comm.bcast(read_response_shape(filename=RESPONSE_FILE) if taskid == MASTER else None, root=MASTER)
+    if NUMROWS is None and NUMCOLS is None:
+        NUMROWS, NUMCOLS = shape
+    elif (NUMROWS, NUMCOLS) != shape:
+        raise ValueError(f'{RESPONSE_FILE} has shape {shape}, but NUMROWS, NUMCOLS = {NUMROWS}, {NUMCOLS}. Set both to None to use the file.')
+
+    # Ordered subsets, checked before anything is loaded
+    if UPDATE_SCHEME == 'osem' and NUM_SUBSETS < 1:
+        raise ValueError(f'NUM_SUBSETS = {NUM_SUBSETS}, but OSEM needs at least one subset.')
+
+    # Working precision of the response
+    if PRECISION not in ('float64', 'float32'):
+        raise ValueError(f"Unknown PRECISION '{PRECISION}'. Use 'float64' or 'float32'.")
+    dtype = np.float32 if PRECISION == 'float32' else np.float64
+
+    # Threads of every process in the hybrid mode
+    if THREAD_BACKEND not in ('blas', 'pool'):
+        raise ValueError(f"Unknown THREAD_BACKEND '{THREAD_BACKEND}'. Use 'blas' or 'pool'.")
+    threading = None
+    if THREADS_PER_RANK is not None:
+        threading = setup_threads(comm)
+        threads, blas_threads, cores, ranks_per_node = threading
+        if THREAD_BACKEND == 'pool' and threads > 1:
+            THREAD_POOL, THREAD_COUNT = ThreadPoolExecutor(max_workers=threads), threads
+        pinned = comm.gather(cores, root=MASTER)
+        if taskid == MASTER:
+            print(f"Hybrid mode: {numtasks} processes ({ranks_per_node} on the master's node) x {threads} threads ('{THREAD_BACKEND}')")
+            print(f'BLAS threads per process: {blas_threads}' if blas_threads is not None else 
+                  'BLAS threads per process: not set (threadpoolctl is not installed, use OMP_NUM_THREADS)')
+            if PIN_THREADS:
+                print(f'Pinned cores per process: {pinned}')
+
+    if ACTIVE_SET and (STREAM_CHUNK_ROWS is not None or BACKPROJECTION != 'reduce' or UPDATE_SCHEME != 'rl' or SHARED_MEMORY 
+                       or PIPELINE_BLOCKS is not None or PROCESS_GRID is not None):
+        raise ValueError("ACTIVE_SET requires an in-memory response, BACKPROJECTION = 'reduce', UPDATE_SCHEME = 'rl' "
+                         "and no SHARED_MEMORY, PIPELINE_BLOCKS or PROCESS_GRID.")
+
+    # Process grid of the 2D decomposition. Process (grid_row, grid_col) 
+    # holds the block of the grid_row-th row range and grid_col-th column 
+    # range of the response. row_comm connects the processes of a grid row, 
+    # col_comm those of a grid column, both ordered so that master is rank 0. 
+    # Otherwise, the rows and columns are each split over all processes.
+    if PROCESS_GRID is not None:
+        grid_rows, grid_cols = PROCESS_GRID
+        if grid_rows * grid_cols != numtasks:
+            raise ValueError(f'PROCESS_GRID = {PROCESS_GRID} does not match the {numtasks} processes.')
+        if (RESPONSE_FORMAT != 'dense' or BACKPROJECTION != 'reduce' or UPDATE_SCHEME != 'rl' or STREAM_CHUNK_ROWS is not None 
+                or SHARED_MEMORY or PIPELINE_BLOCKS is not None):
+            raise ValueError("PROCESS_GRID requires RESPONSE_FORMAT = 'dense', BACKPROJECTION = 'reduce', UPDATE_SCHEME = 'rl' "
+                             "and no STREAM_CHUNK_ROWS, SHARED_MEMORY or PIPELINE_BLOCKS.")
+        grid_row, grid_col = divmod(taskid, grid_cols)
+        row_comm = comm.Split(grid_row, key=grid_col)
+        col_comm = comm.Split(grid_col, key=grid_row)
+    else:
+        grid_rows = grid_cols = numtasks
+        grid_row = grid_col = taskid
 
-    # Initialise vectors required by all processes
-    M = np.empty(NUMCOLS, dtype=np.float64)     # Loaded and broadcasted by master. 
-    d = np.empty(NUMROWS, dtype=np.float64)     # Loaded and broadcasted by master. 
-    epsilon = np.zeros(NUMROWS)                 # All gatherv-ed.
-    epsilon_fudge = 1e-12                       # To prevent divide-by-zero error
-    bkg = np.zeros(NUMROWS)                     # Loaded and broadcasted by master.
+    # Nonzero profiles of the response, read by master
+    if PARTITION not in ('count', 'nnz'):
+        raise ValueError(f"Unknown PARTITION '{PARTITION}'. Use 'count' or 'nnz'.")
+    profiles = load_cost_profiles(filename=RESPONSE_FILE) if taskid == MASTER else None
+    if PARTITION == 'nnz' and not comm.bcast(profiles is not None, root=MASTER):
+        raise ValueError(f"PARTITION = 'nnz' requires the 'row_nnz' and 'col_nnz' profiles in {RESPONSE_FILE}. Flatten it again with datapreprocessing.py.")
 
     # Calculate the indices in Rij that the process has to parse. My hunch is that calculating these scalars individually will be faster than the MPI send broadcast overhead.
-    averow = NUMROWS // numtasks
-    extra_rows = NUMROWS % numtasks
-    start_row = taskid * averow
-    end_row = (taskid + 1) * averow if taskid < (numtasks - 1) else NUMROWS
+    # With ACTIVE_SET, only the rows with counts are iterated, so master 
+    # balances those (weighted by their nonzeros with PARTITION = 'nnz').
+    if ACTIVE_SET:
+        row_cost = None
+        if taskid == MASTER:
+            counts = np.zeros(NUMROWS, dtype=bool)
+            for signal_files, bkg_file in DATASETS:
+                counts |= (load_bg_model(filename=bkg_file) + sum(load_signal_counts(filename=f) for f in signal_files)) > 0
+            row_cost = counts * (profiles[0] if PARTITION == 'nnz' else NUMCOLS)
+        row_counts, row_displacements = comm.bcast(balanced_partition(row_cost, grid_rows) if taskid == MASTER else None, root=MASTER)
+        start_row = row_displacements[grid_row]
+        end_row = start_row + row_counts[grid_row]
+    elif PARTITION == 'nnz':
+        row_counts, row_displacements = comm.bcast(balanced_partition(profiles[0], grid_rows) if taskid == MASTER else None, root=MASTER)
+        start_row = row_displacements[grid_row]
+        end_row = start_row + row_counts[grid_row]
+    else:
+        averow = NUMROWS // grid_rows
+        extra_rows = NUMROWS % grid_rows
+        start_row = grid_row * averow
+        end_row = (grid_row + 1) * averow if grid_row < (grid_rows - 1) else NUMROWS
+        row_counts = np.array([averow] * (grid_rows-1) + [averow + extra_rows])
+        row_displacements = np.arange(grid_rows) * averow
+
+    # Communicators of the ranks sharing a node and of the first rank of 
+    # every node (master is the first rank of its node)
+    shared_windows = []
+    if SHARED_MEMORY:
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=taskid)
+        node_rank = node_comm.Get_rank()
+        leader_comm = comm.Split(0 if node_rank == 0 else MPI.UNDEFINED, key=taskid)
+
+    # Initialise vectors required by all processes. One column per dataset.
+    # The full-length data-space vectors are only needed by the master, which 
+    # loads them, and by every process in the 'transpose' scheme. Otherwise 
+    # each process only holds its own rows.
+    K = len(DATASETS)
+    full_data_space = BACKPROJECTION == 'transpose' or taskid == MASTER
+    if SHARED_MEMORY:
+        win, M = allocate_shared_array(node_comm, (NUMCOLS, K))      # One copy per node
+        shared_windows.append(win)
+    else:
+        M = np.empty((NUMCOLS, K), dtype=np.float64)    # Loaded and broadcasted by master. 
+    d = np.empty((NUMROWS, K), dtype=np.float64) if full_data_space else None     # Loaded by master. 
+    bkg = np.zeros((NUMROWS, K)) if full_data_space else None                     # Loaded by master.
+    d_local = np.empty((end_row - start_row, K), dtype=np.float64)                # Scattered by master.
+    bkg_local = np.zeros((end_row - start_row, K))                                # Scattered by master.
+    epsilon = np.zeros((NUMROWS, K)) if BACKPROJECTION == 'transpose' else None   # All gatherv-ed. Only used by the 'transpose' scheme.
+    epsilon_fudge = 1e-12                           # To prevent divide-by-zero error
+
+    # M as broadcast for the projections. In float32 a separate single 
+    # precision copy, filled by master, except where the processes also 
+    # update M (accelerated) or share it (SHARED_MEMORY).
+    if PRECISION == 'float32' and UPDATE_SCHEME != 'accelerated' and not SHARED_MEMORY:
+        M_bcast = np.empty((NUMCOLS, K), dtype=np.float32)
+    else:
+        M_bcast = M
 
     # Calculate the indices in Rji, i.e., Rij transpose, that the process has to parse.
-    avecol = NUMCOLS // numtasks
-    extra_cols = NUMCOLS % numtasks
-    start_col = taskid * avecol
-    end_col = (taskid + 1) * avecol if taskid < (numtasks - 1) else NUMCOLS
+    if PARTITION == 'nnz':
+        col_counts, col_displacements = comm.bcast(balanced_partition(profiles[1], grid_cols) if taskid == MASTER else None, root=MASTER)
+        start_col = col_displacements[grid_col]
+        end_col = start_col + col_counts[grid_col]
+    else:
+        avecol = NUMCOLS // grid_cols
+        extra_cols = NUMCOLS % grid_cols
+        start_col = grid_col * avecol
+        end_col = (grid_col + 1) * avecol if grid_col < (grid_cols - 1) else NUMCOLS
+        col_counts = np.array([avecol] * (grid_cols-1) + [avecol + extra_cols])
+        col_displacements = np.arange(grid_cols) * avecol
+
+    # Report the imbalance of nonzeros per process. The rows are used by 
+    # every scheme, the columns only by the 'transpose' scheme and the 2D 
+    # decomposition.
+    imbalance = None
+    if taskid == MASTER and profiles is not None:
+        imbalance = {'rows': partition_imbalance(profiles[0], row_counts, row_displacements), 
+                     'cols': partition_imbalance(profiles[1], col_counts, col_displacements)}
+        print(f"Nonzeros per process (max/mean): rows {imbalance['rows']:.3f}, columns {imbalance['cols']:.3f}")
 
     # Load R and RT into memory (single time if response matrix doesn't 
-    # change with time)
-    R = load_response_matrix(comm, start_row, end_row, filename='psr_gal_flattened_511_DC2.h5')
-    RT = load_response_matrix_transpose(comm, start_col, end_col, filename='psr_gal_flattened_511_DC2.h5')
+    # change with time). RT is only required by the 'transpose' scheme.
+    with timer.phase('load_response') as stats:
+        if RESPONSE_FORMAT not in ('dense', 'csr'):
+            raise ValueError(f"Unknown RESPONSE_FORMAT '{RESPONSE_FORMAT}'. Use 'dense' or 'csr'.")
+        if SHARED_MEMORY and (BACKPROJECTION != 'reduce' or STREAM_CHUNK_ROWS is not None or UPDATE_SCHEME == 'accelerated'):
+            raise ValueError("SHARED_MEMORY requires BACKPROJECTION = 'reduce', no STREAM_CHUNK_ROWS and UPDATE_SCHEME 'rl' or 'osem'.")
+        # The service keeps the in-memory slabs resident between runs
+        resident = RESIDENT_RESPONSE is not None and not SHARED_MEMORY and STREAM_CHUNK_ROWS is None
+        resident_key = (RESPONSE_FILE, RESPONSE_FORMAT, PRECISION, BACKPROJECTION, PROCESS_GRID, start_row, end_row, start_col, end_col)
+        if resident and resident_key in RESIDENT_RESPONSE:
+            R, RT = RESIDENT_RESPONSE[resident_key]
+        else:
+            if PROCESS_GRID is not None:
+                R = load_response_block(comm, start_row, end_row, start_col, end_col, dtype=dtype, filename=RESPONSE_FILE)
+            elif SHARED_MEMORY:
+                # The first rank of every node reads the rows of the whole node
+                node_rows = node_comm.allgather((start_row, end_row))
+                node_start = min(row[0] for row in node_rows)
+                node_end = max(row[1] for row in node_rows)
+                if not comm.allreduce(sum(row[1] - row[0] for row in node_rows) == node_end - node_start, op=MPI.LAND):
+                    raise ValueError('SHARED_MEMORY requires the ranks of every node to be consecutive.')
+                R_node = None
+                if node_rank == 0 and RESPONSE_FORMAT == 'csr':
+                    R_node = load_sparse_response_matrix(leader_comm, node_start, node_end, dtype=dtype, filename=RESPONSE_FILE)
+                elif node_rank == 0:
+                    R_node = (load_response_matrix(leader_comm, node_start, node_end, dtype=dtype, filename=RESPONSE_FILE),)
+                parts = []
+                for i in range(3 if RESPONSE_FORMAT == 'csr' else 1):
+                    win, part = share_array(node_comm, R_node[i] if node_rank == 0 else None)
+                    shared_windows.append(win)
+                    parts.append(part)
+                R_node = (*parts, node_end - node_start) if RESPONSE_FORMAT == 'csr' else parts[0]
+                R = slice_rows(R_node, start_row - node_start, end_row - node_start)
+            elif STREAM_CHUNK_ROWS is not None:
+                if BACKPROJECTION != 'reduce':
+                    raise ValueError("STREAM_CHUNK_ROWS requires BACKPROJECTION = 'reduce'.")
+                R = open_streamed_response_matrix(comm, start_row, end_row, STREAM_CHUNK_ROWS, STREAM_READ_AHEAD, 
+                                                  sparse=RESPONSE_FORMAT == 'csr', dtype=dtype, filename=RESPONSE_FILE)
+            elif RESPONSE_FORMAT == 'csr':
+                if BACKPROJECTION != 'reduce':
+                    raise ValueError("RESPONSE_FORMAT = 'csr' requires BACKPROJECTION = 'reduce'.")
+                R = load_sparse_response_matrix(comm, start_row, end_row, dtype=dtype, filename=RESPONSE_FILE)
+            else:
+                R = load_response_matrix(comm, start_row, end_row, dtype=dtype, filename=RESPONSE_FILE)
+            if BACKPROJECTION == 'transpose':
+                RT = load_response_matrix_transpose(comm, start_col, end_col, dtype=dtype, filename=RESPONSE_FILE)
+            elif BACKPROJECTION != 'reduce':
+                raise ValueError(f"Unknown BACKPROJECTION scheme '{BACKPROJECTION}'. Use 'reduce' or 'transpose'.")
+            if isinstance(R, np.ndarray):
+                stats['bytes'] = R.nbytes
+            elif isinstance(R, tuple):
+                stats['bytes'] = R[1].nbytes + R[2].nbytes
+            if BACKPROJECTION == 'transpose':
+                stats['bytes'] += RT.nbytes
+            if SHARED_MEMORY:
+                stats['bytes'] = sum(part.nbytes for part in parts) if node_rank == 0 else 0
+            if resident:
+                RESIDENT_RESPONSE[resident_key] = (R, RT if BACKPROJECTION == 'transpose' else None)
+
+    if UPDATE_SCHEME not in ('rl', 'osem', 'accelerated'):
+        raise ValueError(f"Unknown UPDATE_SCHEME '{UPDATE_SCHEME}'. Use 'rl', 'osem' or 'accelerated'.")
+    if UPDATE_SCHEME != 'rl' and BACKPROJECTION != 'reduce':
+        raise ValueError(f"UPDATE_SCHEME = '{UPDATE_SCHEME}' requires BACKPROJECTION = 'reduce'.")
+    if PIPELINE_BLOCKS is not None and (not isinstance(R, np.ndarray) or UPDATE_SCHEME == 'accelerated'):
+        raise ValueError("PIPELINE_BLOCKS requires a dense response held in memory and UPDATE_SCHEME 'rl' or 'osem'.")
+
+    # Sub-blocks of the pipelined collectives: blocks of pixels of M and C in 
+    # the 'reduce' scheme, rounds over every rank's rows of epsilon and 
+    # columns of C in the 'transpose' scheme. With SHARED_MEMORY, M is 
+    # broadcast as a whole.
+    pipelined_reduce = PIPELINE_BLOCKS is not None and BACKPROJECTION == 'reduce'
+    pipelined_transpose = PIPELINE_BLOCKS is not None and BACKPROJECTION == 'transpose'
+    if pipelined_reduce:
+        col_blocks = np.linspace(0, NUMCOLS, PIPELINE_BLOCKS + 1).astype(int)
+        col_blocks = list(zip(col_blocks[:-1], col_blocks[1:]))
+    if pipelined_transpose:
+        epsilon_rounds = pipeline_rounds(row_counts, row_displacements, taskid, PIPELINE_BLOCKS, K)
+        C_rounds = pipeline_rounds(col_counts, col_displacements, taskid, PIPELINE_BLOCKS, K)
+
+    # Split the row slab into contiguous subsets. Only OSEM uses more than one.
+    numsubsets = NUM_SUBSETS if UPDATE_SCHEME == 'osem' else 1
+    subset_edges = np.linspace(0, end_row - start_row, numsubsets + 1).astype(int)
+    R_subsets = [slice_rows(R, lo, hi) for lo, hi in zip(subset_edges[:-1], subset_edges[1:])]
 
     # Initialise epsilon_slice and C_slice
     epsilon_slice = np.zeros(end_row - start_row)
@@ -116,38 +1116,40 @@ def main():
         linebreak_stars = '**********************'
         linebreak_dashes = '----------------------'
 
-        # Load Rj vector (response matrix summed along axis=i)
-        Rj = load_axis0_summed_response_matrix(filename='psr_gal_flattened_511_DC2.h5')
+        with timer.phase('load_data'):
+            # Load Rj vector (response matrix summed along axis=i)
+            if RESIDENT_RESPONSE is not None and ('Rj', RESPONSE_FILE) in RESIDENT_RESPONSE:
+                Rj = RESIDENT_RESPONSE[('Rj', RESPONSE_FILE)]
+            else:
+                Rj = load_axis0_summed_response_matrix(filename=RESPONSE_FILE)
+                if RESIDENT_RESPONSE is not None:
+                    RESIDENT_RESPONSE[('Rj', RESPONSE_FILE)] = Rj
 
-        # Load sky model input
-        M = initial_sky_model()
+            # Load sky model input
+            M0 = initial_sky_model(WARM_START)
+            M[:] = M0 if M0.ndim == 2 else M0[:, np.newaxis]
 
-        # Load observed data counts
-        # XXX: Only simulations give access to signal. Eventually, 
-        # we will only have observed counts d and a simulated background model.
-        # signal1 = load_signal_counts(filename='data/Ti44_CasA_dense.hdf5')
-        # signal2 = load_signal_counts(filename='data/Ti44_G1903_dense.hdf5')
-        # signal3 = load_signal_counts(filename='data/Ti44_SN1987A_dense.hdf5')
-        # bkg = load_bg_model()
-        # d = signal1 + signal2 + signal3 + bkg
-        signal = load_signal_counts(filename='data/511_thin_disk_dense.h5')
-        bkg = load_bg_model(filename='data/albedo_bg_dense.h5')
-        d = signal + bkg
+            # Load observed data counts
+            for k, (signal_files, bkg_file) in enumerate(DATASETS):
+                bkg[:, k] = load_bg_model(filename=bkg_file)
+                d[:, k] = bkg[:, k]
+                for signal_file in signal_files:
+                    d[:, k] += load_signal_counts(filename=signal_file)
 
         # Sanity check: print d
         print()
         print('Observed data-space d vector:')
-        print(d)
+        print(d.T)
         # print(d.min(), d.max())
         ## Pretty print
         print()
         print(linebreak_stars)
 
         # Initialise C vector. Only master requires full length.
-        C = np.empty(NUMCOLS, dtype=np.float64)
+        C = np.empty((NUMCOLS, K), dtype=np.float64)
 
         # Initialise update delta vector
-        delta = np.empty(NUMCOLS, dtype=np.float64)
+        delta = np.empty((NUMCOLS, K), dtype=np.float64)
 
     '''*************** Worker ***************'''
 
@@ -156,15 +1158,86 @@ def main():
         # Initialise C vector to None. Only master requires full length.
         C = None
 
-    # Broadcast d vector
-    comm.Bcast([d, MPI.DOUBLE], root=MASTER)
+    if BACKPROJECTION == 'transpose':
+        with timer.phase('bcast_data', d.nbytes + bkg.nbytes):
+            # Broadcast d vector
+            comm.Bcast([d, MPI.DOUBLE], root=MASTER)
 
-    # Scatter bkg vector to epsilon_BG
-    comm.Bcast([bkg, MPI.DOUBLE], root=MASTER)
-    # comm.Scatter(bkg, [epsilon_BG, recvcounts, displacements, MPI.DOUBLE])
+            # Broadcast bkg vector
+            comm.Bcast([bkg, MPI.DOUBLE], root=MASTER)
+        d_local = d[start_row:end_row]
+        bkg_local = bkg[start_row:end_row]
+    elif PROCESS_GRID is not None:
+        with timer.phase('scatter_data', d_local.nbytes + bkg_local.nbytes):
+            # Scatter the row ranges of d and bkg vectors down the first grid 
+            # column and broadcast them along the grid rows
+            if grid_col == 0:
+                col_comm.Scatterv([d, row_counts * K, row_displacements * K, MPI.DOUBLE], [d_local, MPI.DOUBLE], root=0)
+                col_comm.Scatterv([bkg, row_counts * K, row_displacements * K, MPI.DOUBLE], [bkg_local, MPI.DOUBLE], root=0)
+            row_comm.Bcast([d_local, MPI.DOUBLE], root=0)
+            row_comm.Bcast([bkg_local, MPI.DOUBLE], root=0)
+        d = bkg = None
+    else:
+        with timer.phase('scatter_data', d_local.nbytes + bkg_local.nbytes):
+            # Scatter the rows of d and bkg vectors
+            comm.Scatterv([d, row_counts * K, row_displacements * K, MPI.DOUBLE], [d_local, MPI.DOUBLE], root=MASTER)
+            comm.Scatterv([bkg, row_counts * K, row_displacements * K, MPI.DOUBLE], [bkg_local, MPI.DOUBLE], root=MASTER)
+        d = bkg = None
 
     # print(f"TaskID {taskid}, gathered broadcast")
 
+    # Poisson realization of the counts for run_ensemble(). Every process 
+    # draws its own rows, or all rows with 'transpose', where every process 
+    # holds d.
+    if realization is not None:
+        if BACKPROJECTION == 'transpose':
+            d = np.random.default_rng([ENSEMBLE_SEED, realization]).poisson(d).astype(np.float64)
+            d_local = d[start_row:end_row]
+        else:
+            d_local = np.random.default_rng([ENSEMBLE_SEED, realization, start_row]).poisson(d_local).astype(np.float64)
+
+    # Rj of each OSEM subset, i.e., the subset's rows summed along axis=i
+    if UPDATE_SCHEME == 'osem':
+        Rj_partial = np.array([back_project(R_s, np.ones(hi - lo)) for R_s, lo, hi in zip(R_subsets, subset_edges[:-1], subset_edges[1:])])
+        Rj_subsets = np.empty_like(Rj_partial) if taskid == MASTER else None
+        with timer.phase('reduce_Rj', Rj_partial.nbytes):
+            comm.Reduce([Rj_partial, MPI.DOUBLE], Rj_subsets, op=MPI.SUM, root=MASTER)
+    elif taskid == MASTER:
+        Rj_subsets = [Rj]
+
+    # Broadcast Rj against the dataset columns
+    if taskid == MASTER:
+        Rj_subsets = [Rj_s[:, np.newaxis] for Rj_s in Rj_subsets]
+
+    # Active set. Every rank keeps the rows of its slab with counts, with all 
+    # pixels in R and with the active pixels only in R_subsets[0]. The 
+    # dropped rows enter the log-likelihood through their column sums.
+    if ACTIVE_SET:
+        row_active = np.any(d_local > 0, axis=1)
+        with timer.phase('active_set'):
+            R_dropped_sum = back_project(restrict_slab(R, rows=~row_active), np.ones(np.count_nonzero(~row_active)))
+            bkg_dropped_sum = bkg_local[~row_active].sum(axis=0) + epsilon_fudge * np.count_nonzero(~row_active)
+            R = restrict_slab(R, rows=row_active)
+        R_subsets = [R]
+        subset_edges = [0, np.count_nonzero(row_active)]
+        d_local = d_local[row_active]
+        bkg_rows = bkg_local = bkg_local[row_active]
+        col_active = np.ones(NUMCOLS, dtype=bool)
+        compact = isinstance(R, np.ndarray)         # Dense slabs are compacted to the active pixels
+        active_rows = comm.reduce(np.count_nonzero(row_active), op=MPI.SUM, root=MASTER)
+        if taskid == MASTER:
+            print(f'Active set: {active_rows} of {NUMROWS} rows have counts')
+
+    # In the 2D decomposition, the first grid row updates M, one column range 
+    # per process, so it needs the matching ranges of Rj
+    if PROCESS_GRID is not None:
+        M_local = np.empty((end_col - start_col, K), dtype=np.float64)
+        C_local = np.empty((end_col - start_col, K), dtype=np.float64) if grid_row == 0 else None
+        if grid_row == 0:
+            Rj_local = np.empty((end_col - start_col, 1), dtype=np.float64)
+            row_comm.Scatterv([Rj_subsets[0] if taskid == MASTER else None, col_counts, col_displacements, MPI.DOUBLE], 
+                              [Rj_local, MPI.DOUBLE], root=0)
+
     # Sanity check: print epsilon
     # if taskid == MASTER:
     #     print('epsilon_BG')
@@ -177,69 +1250,319 @@ def main():
     # Set up initial values for iterating variables.
     # Exit if:
     ## 1. Max iterations are reached
-    ## 2. M vector converges
-    for iter in range(MAXITER):
+    ## 2. M vector converges (TOL_M), log-likelihood converges (TOL_LOGL), 
+    ## or the wall-clock budget (WALLTIME) is used up
+    check_convergence = any(tol is not None for tol in (TOL_M, TOL_LOGL, WALLTIME))
+    logL = None
+    start_iter = 0
+
+    # Resume from the last checkpoint
+    if taskid == MASTER:
+        if RESUME and CHECKPOINT_FILE is not None and Path(CHECKPOINT_FILE).is_file():
+            with timer.phase('load_checkpoint'):
+                M_checkpoint, start_iter, logL = load_checkpoint(CHECKPOINT_FILE)
+            if M_checkpoint.shape != M.shape:
+                raise ValueError(f'Checkpoint {CHECKPOINT_FILE} holds M of shape {M_checkpoint.shape}, expected {M.shape}.')
+            M[:] = M_checkpoint
+            print(f'Resuming from checkpoint {CHECKPOINT_FILE} after iteration {start_iter}')
+
+        # Checkpoints are written on a background thread
+        if CHECKPOINT_FILE is not None:
+            checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+            checkpoint_pending = None
+    if RESUME:
+        start_iter = comm.bcast(start_iter, root=MASTER)
+
+    # Scatter the column ranges of M along the first grid row
+    if PROCESS_GRID is not None and grid_row == 0:
+        row_comm.Scatterv([M, col_counts * K, col_displacements * K, MPI.DOUBLE], [M_local, MPI.DOUBLE], root=0)
+
+    start_time = MPI.Wtime()
+    for iter in range(start_iter, MAXITER):
+        timer.iteration = iter
 
         '''*************** Master ***************'''
         if taskid == MASTER:
             # Pretty print - starting
             print(f"Starting iteration {iter + 1}")
+            M_prev = M.copy()
 
+        # Local log-likelihood summed over all (sub-)iterations
+        logL_local = 0.
+
+        # Sub-iterations over the OSEM subsets. All other schemes have a single 
+        # subset covering the entire row slab.
+        for s, R_s in enumerate(R_subsets):
+            lo = subset_edges[s]
+            hi = subset_edges[s + 1]
+            d_s = d_local[lo:hi]
 
     # Calculate epsilon vector and all gatherv
 
-        '''**************** All *****************'''
+            '''**************** All *****************'''
+
+            # The accelerated scheme updates epsilon alongside M, so only needs 
+            # M and the forward projection in the first iteration
+            C_partial = None
+            if PROCESS_GRID is not None:
+                '''Synchronization Barrier 1'''
+                # Broadcast the column range of M down the grid column
+                with timer.phase('bcast_M', M_local.nbytes):
+                    col_comm.Bcast([M_local, MPI.DOUBLE], root=0)
+
+                # Partial epsilon of the block, summed along the grid row
+                with timer.phase('forward'):
+                    epsilon_slice = forward_project(R_s, M_local)
+                with timer.phase('allreduce_epsilon', epsilon_slice.nbytes):
+                    row_comm.Allreduce(MPI.IN_PLACE, [epsilon_slice, MPI.DOUBLE], op=MPI.SUM)
+                epsilon_slice += bkg_local[lo:hi] + epsilon_fudge
+
+            elif pipelined_reduce and not SHARED_MEMORY:
+                '''Synchronization Barrier 1'''
+                # Receive M block by block while projecting the blocks that 
+                # have already arrived
+                with timer.phase('bcast_M_forward', M.nbytes):
+                    requests = [comm.Ibcast([M[a:b], MPI.DOUBLE], root=MASTER) for a, b in col_blocks]
+                    epsilon_slice = bkg_local[lo:hi] + epsilon_fudge
+                    for (a, b), request in zip(col_blocks, requests):
+                        request.Wait()
+                        epsilon_slice = epsilon_slice + forward_project(R_s[:, a:b], M[a:b])
 
-        '''Synchronization Barrier 1'''
-        # Broadcast M vector
-        comm.Bcast([M, MPI.DOUBLE], root=MASTER)
+            elif UPDATE_SCHEME != 'accelerated' or iter == start_iter:
+                '''Synchronization Barrier 1'''
+                # Broadcast M vector
+                with timer.phase('bcast_M', M_bcast.nbytes):
+                    if SHARED_MEMORY:
+                        # Only the first rank of every node receives M. The 
+                        # others have sent their partial C, so are no longer 
+                        # reading the previous M, and wait until it arrives.
+                        if node_rank == 0:
+                            leader_comm.Bcast([M, MPI.DOUBLE], root=MASTER)
+                        node_comm.Barrier()
+                    else:
+                        if taskid == MASTER and M_bcast is not M:
+                            M_bcast[:] = M
+                        comm.Bcast([M_bcast, MPI.FLOAT if M_bcast.dtype == np.float32 else MPI.DOUBLE], root=MASTER)
 
-        # Calculate epsilon slice
-        epsilon_BG = bkg[start_row:end_row]             # TODO: Change the way epsilon_BG is loaded. Make it taskID dependent through MPI.Scatter for example. Use `recvcounts`
-        epsilon_slice = np.dot(R, M) + epsilon_BG + epsilon_fudge
+                # Active set. Every ACTIVE_SET_EVERY iterations, a full 
+                # iteration lets master re-check the pixels. In the next one, 
+                # the pixels it froze are removed from the slab and their 
+                # (fixed) contribution is added to the background.
+                M_s = M_bcast
+                if ACTIVE_SET and (iter - start_iter) % ACTIVE_SET_EVERY < 2:
+                    with timer.phase('active_set'):
+                        if (iter - start_iter) % ACTIVE_SET_EVERY == 0:
+                            col_active[:] = True
+                            R_subsets[0] = R_s = R
+                            bkg_local = bkg_rows
+                        else:
+                            col_active[:] = comm.bcast(col_active, root=MASTER)
+                            R_subsets[0] = R_s = restrict_slab(R, cols=col_active)
+                            frozen = restrict_slab(R, cols=~col_active)
+                            bkg_local = bkg_rows + forward_project(frozen, M_bcast[~col_active] if compact else M_bcast)
+                if ACTIVE_SET and compact:
+                    M_s = M_bcast[col_active]
 
-        '''Synchronization Barrier 2'''
-        # All vector gather epsilon slices
-        recvcounts = [averow] * (numtasks-1) + [averow + extra_rows]
-        displacements = np.arange(numtasks) * averow
-        comm.Allgatherv(epsilon_slice, [epsilon, recvcounts, displacements, MPI.DOUBLE])
+                # Calculate epsilon slice. In the 'reduce' scheme, the slab is 
+                # back-projected in the same pass, so that it is read once per 
+                # iteration.
+                epsilon_BG = bkg_local[lo:hi]
+                if isinstance(R_s, StreamedSlab) or (BACKPROJECTION == 'reduce' and not pipelined_reduce and FUSED_BLOCK_BYTES is not None):
+                    with timer.phase('project'):
+                        epsilon_slice, C_partial = forward_back_project(R_s, M_s, epsilon_BG + epsilon_fudge, d_s)
+                elif pipelined_transpose:
+                    '''Synchronization Barrier 2'''
+                    # All vector gather the epsilon sub-blocks while the next 
+                    # ones are projected
+                    with timer.phase('forward_allgatherv_epsilon', epsilon.nbytes):
+                        epsilon_slice = np.empty((hi - lo, K))
+                        requests = []
+                        for (a, b), counts, displacements in epsilon_rounds:
+                            epsilon_slice[a:b] = forward_project(R_s[a:b], M_bcast) + epsilon_BG[a:b] + epsilon_fudge
+                            requests.append(comm.Iallgatherv(epsilon_slice[a:b], [epsilon, counts, displacements, MPI.DOUBLE]))
+                        MPI.Request.Waitall(requests)
+                else:
+                    with timer.phase('forward'):
+                        epsilon_slice = forward_project(R_s, M_s) + epsilon_BG + epsilon_fudge
 
-        # Sanity check: print epsilon
-        # if taskid == MASTER:
-        #     print('epsilon')
-        #     print(epsilon)
-        #     print(epsilon.min(), epsilon.max())
-        #     print()
+            # Every process of a grid row holds the same epsilon
+            if TOL_LOGL is not None and (PROCESS_GRID is None or grid_col == 0):
+                logL_local += poisson_log_likelihood(d_s, epsilon_slice)
+                if ACTIVE_SET:
+                    logL_local -= R_dropped_sum @ M_bcast + bkg_dropped_sum
+
+            if BACKPROJECTION == 'transpose' and not pipelined_transpose:
+                '''Synchronization Barrier 2'''
+                # All vector gather epsilon slices
+                with timer.phase('allgatherv_epsilon', epsilon.nbytes):
+                    comm.Allgatherv(epsilon_slice, [epsilon, row_counts * K, row_displacements * K, MPI.DOUBLE])
+
+            # Sanity check: print epsilon
+            # if taskid == MASTER:
+            #     print('epsilon')
+            #     print(epsilon)
+            #     print(epsilon.min(), epsilon.max())
+            #     print()
 
 # **************************** Part IIb *****************************
 
     # Calculate C vector and gatherv
     
-        '''**************** All *****************'''
+            '''**************** All *****************'''
+
+            if PROCESS_GRID is not None:
+                # Partial C of the block, summed down the grid column onto the 
+                # first grid row
+                with timer.phase('backproject'):
+                    C_partial = back_project(R_s, d_s/epsilon_slice)
+
+                '''Synchronization Barrier 2'''
+                with timer.phase('reduce_C', C_partial.nbytes):
+                    col_comm.Reduce([C_partial, MPI.DOUBLE], C_local, op=MPI.SUM, root=0)
+
+            elif pipelined_transpose:
+                '''Synchronization Barrier 3'''
+                # Gather the C sub-blocks while the next ones are back-projected
+                with timer.phase('backproject_gatherv_C') as stats:
+                    y = d/epsilon
+                    C_slice = np.empty((end_col - start_col, K))
+                    requests = []
+                    for (a, b), counts, displacements in C_rounds:
+                        C_slice[a:b] = back_project(RT[:, a:b], y)
+                        requests.append(comm.Igatherv(C_slice[a:b], [C, counts, displacements, MPI.DOUBLE], root=MASTER))
+                    MPI.Request.Waitall(requests)
+                    stats['bytes'] = C_slice.nbytes
+
+            elif BACKPROJECTION == 'transpose':
+                # Calculate C slice
+                with timer.phase('backproject'):
+                    C_slice = back_project(RT, d/epsilon)
+
+                '''Synchronization Barrier 3'''
+                # All vector gather C slices
+                with timer.phase('gatherv_C', C_slice.nbytes):
+                    comm.Gatherv(C_slice, [C, col_counts * K, col_displacements * K, MPI.DOUBLE], root=MASTER)
+
+            elif pipelined_reduce:
+                '''Synchronization Barrier 2'''
+                # Sum the blocks of the partial C vectors onto master while the 
+                # next ones are back-projected. Master updates each block of M 
+                # as soon as its sum has arrived.
+                with timer.phase('backproject_reduce_C') as stats:
+                    y = d_s/epsilon_slice
+                    C_partial = np.empty((NUMCOLS, K))
+                    requests = []
+                    for a, b in col_blocks:
+                        C_partial[a:b] = back_project(R_s[:, a:b], y)
+                        requests.append(comm.Ireduce([C_partial[a:b], MPI.DOUBLE], None if C is None else C[a:b], op=MPI.SUM, root=MASTER))
+                    for (a, b), request in zip(col_blocks, requests):
+                        request.Wait()
+                        if taskid == MASTER:
+                            delta[a:b] = rl_delta(C[a:b], Rj_subsets[s][a:b])
+                            M[a:b] = M[a:b] + delta[a:b] * M[a:b]
+                    stats['bytes'] = C_partial.nbytes
 
-        # Calculate C slice
-        C_slice = np.dot(RT.T, d/epsilon)
+            else:
+                # Calculate this rank's full-length contribution to C from its 
+                # own rows only. No need for the full epsilon vector.
+                if C_partial is None:
+                    with timer.phase('backproject'):
+                        C_partial = back_project(R_s, d_s/epsilon_slice)
+                if ACTIVE_SET and compact:
+                    C_partial_active, C_partial = C_partial, np.zeros((NUMCOLS, K))
+                    C_partial[col_active] = C_partial_active
 
-        '''Synchronization Barrier 3'''
-        # All vector gather C slices
-        recvcounts = [avecol] * (numtasks-1) + [avecol + extra_cols]
-        displacements = np.arange(numtasks) * avecol
-        comm.Gatherv(C_slice, [C, recvcounts, displacements, MPI.DOUBLE], root=MASTER)
+                '''Synchronization Barrier 2'''
+                # Sum partial C vectors onto master
+                with timer.phase('reduce_C', C_partial.nbytes):
+                    comm.Reduce([C_partial, MPI.DOUBLE], C, op=MPI.SUM, root=MASTER)
 
 # **************************** Part IIb *****************************
 
     # Iterative update of model-space M vector
 
-        if taskid == MASTER:
+            if PROCESS_GRID is not None:
+                # The first grid row updates its column ranges of M and 
+                # gathers them onto master
+                if grid_row == 0:
+                    with timer.phase('update'):
+                        M_local = M_local + rl_delta(C_local, Rj_local) * M_local
+
+                    '''Synchronization Barrier 3'''
+                    with timer.phase('gatherv_M', M_local.nbytes):
+                        row_comm.Gatherv([M_local, MPI.DOUBLE], [M, col_counts * K, col_displacements * K, MPI.DOUBLE], root=0)
+
+            elif UPDATE_SCHEME == 'accelerated':
+                # RL update direction delta * M, computed by master
+                if taskid == MASTER:
+                    with timer.phase('update'):
+                        delta = rl_delta(C, Rj_subsets[s])
+                        direction = delta * M
+                else:
+                    direction = np.empty((NUMCOLS, K), dtype=np.float64)
+
+                '''Synchronization Barrier 3'''
+                # Broadcast update direction. All processes keep M in sync.
+                with timer.phase('bcast_direction', direction.nbytes):
+                    comm.Bcast([direction, MPI.DOUBLE], root=MASTER)
+
+                # Largest step per dataset keeping M positive. The plain RL 
+                # step (1) always does.
+                step_bound = np.full((NUMCOLS, K), np.inf)
+                np.divide(-M, direction, out=step_bound, where=direction < 0)
+                step_max = np.clip(0.99 * step_bound.min(axis=0), 1., ACCELERATION_MAX)
+
+                # Line search along the forward-projected direction
+                with timer.phase('forward'):
+                    r = forward_project(R, direction)
+                with timer.phase('line_search'):
+                    step = line_search(comm, d_s, epsilon_slice, r, step_max)
+                    M = M + step * direction
+                    epsilon_slice = epsilon_slice + step * r
+
+            elif taskid == MASTER and not pipelined_reduce:
+
+                # Sanity check: print C
+                # print('C')
+                # print(C)
+                # print(C.min(), C.max())
+                # print()
 
-            # Sanity check: print C
-            # print('C')
-            # print(C)
-            # print(C.min(), C.max())
-            # print()
+                with timer.phase('update'):
+                    delta = rl_delta(C, Rj_subsets[s])
+                    if ACTIVE_SET:
+                        delta[~col_active] = 0      # Frozen pixels
+                    M[:] = M + delta * M        # Allows for optimization features presented in Siegert et al. 2020
 
-            delta = C / Rj - 1
-            M = M + delta * M           # Allows for optimization features presented in Siegert et al. 2020
+                # After a full iteration, freeze the negligible pixels that 
+                # are not growing
+                if ACTIVE_SET and (iter - start_iter) % ACTIVE_SET_EVERY == 0:
+                    col_active[:] = np.any((M > ACTIVE_SET_THRESHOLD * M.max(axis=0)) | (delta > 0), axis=1)
+                    print(f'Active set: {np.count_nonzero(col_active)} of {NUMCOLS} pixels')
+
+        # Sum log-likelihood of the M vectors in this iteration onto master
+        if TOL_LOGL is not None:
+            logL_prev = logL
+            with timer.phase('reduce_logL', np.dtype(np.float64).itemsize * K):
+                logL = comm.reduce(logL_local, op=MPI.SUM, root=MASTER)
+
+        if taskid == MASTER:
+
+            # Evaluate stopping criteria
+            stop = False
+            if TOL_M is not None:
+                M_change = np.max(np.linalg.norm(M - M_prev, axis=0) / np.linalg.norm(M_prev, axis=0))
+                if M_change < TOL_M:
+                    print(f'M converged: relative change {M_change:.3e} < {TOL_M}')
+                    stop = True
+            if TOL_LOGL is not None and logL_prev is not None:
+                logL_change = np.max(np.abs(logL - logL_prev))
+                if logL_change < TOL_LOGL:
+                    print(f'Log-likelihood converged: change {logL_change:.3e} < {TOL_LOGL}')
+                    stop = True
+            if WALLTIME is not None and MPI.Wtime() - start_time > WALLTIME:
+                print(f'Wall-clock budget of {WALLTIME} s used up')
+                stop = True
 
             # Sanity check: print M
             # print('M')
@@ -257,27 +1580,473 @@ def main():
             # Save iteration
             # np.savetxt(FILE_DIR / f'outputs/Mstep{iter+1}.csv', M)
 
+            # Checkpoint once the previous checkpoint has been written
+            if CHECKPOINT_FILE is not None and ((iter + 1) % CHECKPOINT_EVERY == 0 or stop or iter == MAXITER - 1):
+                with timer.phase('checkpoint'):
+                    if checkpoint_pending is not None:
+                        checkpoint_pending.result()
+                    checkpoint_pending = checkpoint_writer.submit(save_checkpoint, CHECKPOINT_FILE, M.copy(), iter + 1, 
+                                                                  None if logL is None else np.copy(logL))
+
             # MAXITER
             if iter == (MAXITER - 1):
                 print(f'Reached maximum iterations = {MAXITER}')
                 print(linebreak_stars)
                 print()
+            elif stop:
+                print(f'Stopped after {iter + 1} iterations')
+                print(linebreak_stars)
+                print()
+
+        '''Synchronization Barrier 4'''
+        # Broadcast stop decision so that all processes leave the loop together
+        if check_convergence:
+            if taskid > MASTER:
+                stop = None
+            with timer.phase('bcast_stop'):
+                stop = comm.bcast(stop, root=MASTER)
+            if stop:
+                break
   
     '''****************** End Iterative Segment ******************'''
 
     # Print converged M
     if taskid == MASTER:
-        print('Converged M vector:')
-        print(np.round(M, 5))
-        print(np.round(M.max(), 5))
-        print(np.sum(M))
-        print()
+        # Wait for the last checkpoint
+        if CHECKPOINT_FILE is not None:
+            if checkpoint_pending is not None:
+                checkpoint_pending.result()
+            checkpoint_writer.shutdown()
+
+        for k in range(K):
+            print(f'Converged M vector of dataset {k}:' if K > 1 else 'Converged M vector:')
+            print(np.round(M[:, k], 5))
+            print(np.round(M[:, k].max(), 5))
+            print(np.sum(M[:, k]))
+            print()
 
         # Save final output
         # np.savetxt(FILE_DIR / f'outputs/ConvergedM.csv', M)
+        if OUTPUT_FILE is not None:
+            np.savetxt(OUTPUT_FILE, M if K > 1 else M[:, 0])
+            print(f'Converged M written to {OUTPUT_FILE}')
+
+        # Compare against the reference result
+        if COMPARE_WITH is not None:
+            comparison = compare_sky_models(M, COMPARE_WITH)
+            print(f'Largest deviation from {COMPARE_WITH} relative to the peak: {np.array2string(comparison, precision=3)}')
+            print(f'Within COMPARE_RTOL = {COMPARE_RTOL}' if np.all(comparison <= COMPARE_RTOL) else f'Exceeds COMPARE_RTOL = {COMPARE_RTOL}')
+
+    # Close the streamed response file (collectively)
+    if isinstance(R, StreamedSlab):
+        R.response_file.close()
+
+    # Free the shared-memory windows (collectively), keeping a private copy of M
+    if shared_windows:
+        M = M.copy()
+        for win in shared_windows:
+            win.Free()
+
+    # Shut down the projection threads
+    if THREAD_POOL is not None:
+        THREAD_POOL.shutdown()
+        THREAD_POOL, THREAD_COUNT = None, 1
+
+    # Gather timings onto master and write the run report
+    if RUN_REPORT is not None:
+        settings = {'NUMROWS': NUMROWS, 'NUMCOLS': NUMCOLS, 'datasets': K, 'BACKPROJECTION': BACKPROJECTION, 
+                    'RESPONSE_FORMAT': RESPONSE_FORMAT, 'UPDATE_SCHEME': UPDATE_SCHEME, 'SHARED_MEMORY': SHARED_MEMORY, 
+                    'PIPELINE_BLOCKS': PIPELINE_BLOCKS, 
+                    'PARTITION': PARTITION, 'nnz_imbalance': imbalance, 'PROCESS_GRID': PROCESS_GRID, 
+                    'PRECISION': PRECISION, 'ACTIVE_SET': ACTIVE_SET, 'THREAD_BACKEND': THREAD_BACKEND, 
+                    'THREADS_PER_RANK': threading[0] if threading else None, 'BLAS_THREADS': threading[1] if threading else None}
+        write_run_report(comm, timer, RUN_REPORT, settings)
 
     # MPI Shutdown
+    if finalize:
+        MPI.Finalize()
+
+    return M if taskid == MASTER else None
+
+'''
+Value of a setting from the configuration, converted to the type of its 
+default (see SETTING_TYPES). YAML reads 1e-6 as a string and whole numbers 
+as integers, so numbers are converted between int, float and str; anything 
+else that does not fit raises a ValueError before the run starts.
+'''
+def coerce_setting(name, value, defaults=None):
+    default = (globals() if defaults is None else defaults)[name]
+    expected = SETTING_TYPES.get(name, type(default))
+    if value is None:
+        if default is None or name in SETTING_TYPES:
+            return None
+        raise ValueError(f"Setting '{name.lower()}' cannot be null.")
+    if expected is type(None) or isinstance(value, bool) and expected is bool:
+        return value
+    if name == 'THREADS_PER_RANK' and value == 'auto':
+        return value
+    if expected is tuple and isinstance(value, (list, tuple)):
+        return tuple(coerce_number(name, v, int) for v in value)
+    if expected in (int, float):
+        return coerce_number(name, value, expected)
+    if issubclass(expected, Path) and isinstance(value, (str, Path)):
+        return Path(value)
+    if expected is str and isinstance(value, Path):
+        return value
+    if isinstance(value, expected):
+        return value
+    raise ValueError(f"Setting '{name.lower()}' expects a {expected.__name__}, got {value!r}.")
+
+'''
+Number of the expected type (int or float) from an int, float or string, 
+at least SETTING_MINIMUMS[name]
+'''
+def coerce_number(name, value, expected):
+    if not isinstance(value, bool):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            pass
+        else:
+            if number < SETTING_MINIMUMS.get(name, -np.inf):
+                raise ValueError(f"Setting '{name.lower()}' must be at least {SETTING_MINIMUMS[name]}, got {value!r}.")
+            if expected is float:
+                return number
+            if number.is_integer():
+                return int(number)
+    raise ValueError(f"Setting '{name.lower()}' expects a{'n int' if expected is int else ' float'}, got {value!r}.")
+
+'''
+Datasets of the configuration: analysis names from the 'analyses' table, or 
+explicit [signal files, background file] pairs
+'''
+def configure_datasets(entries, analyses):
+    entries = [entries] if isinstance(entries, str) else entries
+    if not isinstance(entries, (list, tuple)):
+        raise ValueError(f'Invalid datasets {entries!r}. Use a list of analysis names or [[signal files], background file] pairs.')
+    datasets = []
+    for entry in entries:
+        if isinstance(entry, str):
+            if entry not in analyses:
+                raise ValueError(f"Unknown analysis '{entry}'. Use one of {sorted(analyses)}.")
+            datasets.append((list(analyses[entry]['signals']), analyses[entry]['background']))
+        elif isinstance(entry, (list, tuple)) and len(entry) == 2 and isinstance(entry[1], str):
+            signal_files, bkg_file = entry
+            datasets.append(([signal_files] if isinstance(signal_files, str) else list(signal_files), bkg_file))
+        else:
+            raise ValueError(f'Invalid dataset {entry!r}. Use an analysis name or a pair [[signal files], background file].')
+    return datasets
+
+'''
+Apply a YAML configuration file (see deconvolution.yaml) and KEY=VALUE 
+overrides to the settings of this module. Keys are the settings in lower 
+case. The key 'response' selects the response file by name from the 
+'responses' table, and 'datasets' holds analysis names from the 'analyses' 
+table or explicit [signal files, background file] pairs. Values are 
+converted to the type of each setting (see coerce_setting).
+'''
+def configure(config_file=None, overrides=()):
+    import yaml
+    config = {}
+    if config_file is not None:
+        with open(config_file) as f:
+            config = yaml.safe_load(f) or {}
+    for override in overrides:
+        key, value = override.split('=', 1)
+        config[key.strip().lower()] = yaml.safe_load(value)
+
+    responses = config.pop('responses', None) or {}
+    analyses = config.pop('analyses', None) or {}
+    settings = {}
+    if 'response' in config:
+        name = config.pop('response')
+        if name not in responses:
+            raise ValueError(f"Unknown response '{name}'. Use one of {sorted(responses)}.")
+        settings['RESPONSE_FILE'] = responses[name]
+    if 'datasets' in config:
+        settings['DATASETS'] = configure_datasets(config.pop('datasets'), analyses)
+
+    configurable = [name for name in globals() if name.isupper() and name not in NOT_CONFIGURABLE]
+    for key, value in config.items():
+        if key.upper() not in configurable:
+            raise ValueError(f"Unknown setting '{key}'. Use one of {sorted(name.lower() for name in configurable)}.")
+        settings[key.upper()] = coerce_setting(key.upper(), value)
+    globals().update(settings)
+
+'''
+Check that a sky model file (WARM_START, COMPARE_WITH or a checkpoint) can 
+be read and holds numcols pixels, for one or K datasets
+'''
+def check_sky_model(name, filename, numcols, K):
+    if not Path(filename).is_file():
+        raise ValueError(f'{name} {filename} does not exist.')
+    M0 = load_checkpoint(filename)[0] if name == 'CHECKPOINT_FILE' else read_sky_model(filename)
+    if M0.shape[0] != numcols or (M0.ndim == 2 and M0.shape[1] != K):
+        raise ValueError(f'{name} {filename} holds M of shape {M0.shape}, expected {numcols} pixels for {K} datasets.')
+
+'''
+Oldest job file in the spool directory (by name for equal modification 
+times), claimed by renaming it to <name>.running. Returns the claimed file 
+and its settings, converted as in configure(), or None. Jobs with invalid 
+settings, missing data files or sky models (WARM_START, 
+COMPARE_WITH, or CHECKPOINT_FILE with RESUME) that do not match the 
+response are renamed to <name>.failed, with the reason in <name>.log. Only 
+the master reads these files, so they are checked here, before the job is 
+broadcast to the other processes.
+'''
+def claim_job(spool_dir, defaults):
+    for job_file in sorted(spool_dir.glob('*.json'), key=lambda f: (f.stat().st_mtime_ns, f.name)):
+        running = job_file.with_suffix('.running')
+        job_file.rename(running)
+        try:
+            with open(running) as f:
+                settings = json.load(f)
+            if not isinstance(settings, dict):
+                raise ValueError('A job file holds a JSON object of settings.')
+            unknown = set(settings) - set(JOB_SETTINGS)
+            if unknown:
+                raise ValueError(f'Unknown job settings {sorted(unknown)}. Use {JOB_SETTINGS}.')
+            for name, value in settings.items():
+                if name == 'DATASETS':
+                    settings[name] = configure_datasets(value, {})
+                else:
+                    settings[name] = coerce_setting(name, value, defaults)
+            job = {**defaults, **settings}
+            for signal_files, bkg_file in job['DATASETS']:
+                for filename in signal_files + [bkg_file]:
+                    if not (BASE_DIR / filename).is_file():
+                        raise ValueError(f'Data file {BASE_DIR / filename} does not exist.')
+            if job['UPDATE_SCHEME'] not in ('rl', 'osem', 'accelerated'):
+                raise ValueError(f"Unknown UPDATE_SCHEME '{job['UPDATE_SCHEME']}'. Use 'rl', 'osem' or 'accelerated'.")
+            numcols = NUMCOLS if NUMCOLS is not None else read_response_shape(filename=RESPONSE_FILE)[1]
+            sky_models = {'WARM_START': job['WARM_START'], 'COMPARE_WITH': job['COMPARE_WITH']}
+            if job['RESUME'] and job['CHECKPOINT_FILE'] is not None and Path(job['CHECKPOINT_FILE']).is_file():
+                sky_models['CHECKPOINT_FILE'] = job['CHECKPOINT_FILE']
+            for name, filename in sky_models.items():
+                if filename is not None:
+                    check_sky_model(name, filename, numcols, len(job['DATASETS']))
+        except Exception as error:
+            # Nothing has been broadcast yet, so any malformed job only fails 
+            # itself and the service moves on to the next one
+            running.with_suffix('.log').write_text(f'{type(error).__name__}: {error}\n')
+            running.rename(job_file.with_suffix('.failed'))
+            print(f'Job {job_file.name} failed: {error}')
+            continue
+        return running, settings
+    return None
+
+'''
+Deconvolution service. Loads the response once and runs the jobs dropped 
+into spool_dir back to back, oldest first, keeping the response slabs and Rj 
+resident. Must be called by all processes.
+'''
+def serve(spool_dir):
+    global RESIDENT_RESPONSE
+    if BACKEND != 'mpi':
+        raise ValueError("SERVICE_SPOOL requires BACKEND = 'mpi'.")
+    comm = MPI.COMM_WORLD
+    taskid = comm.Get_rank()
+    spool_dir = Path(spool_dir)
+    defaults = {name: globals()[name] for name in JOB_SETTINGS}
+    RESIDENT_RESPONSE = {}
+
+    while True:
+        # Master polls the spool directory, the other processes wait for the 
+        # next job in the broadcast
+        job = None
+        if taskid == MASTER:
+            while job is None:
+                if (spool_dir / 'STOP').is_file():
+                    job = 'stop'
+                else:
+                    job = claim_job(spool_dir, defaults)
+                if job is None:
+                    time.sleep(SERVICE_POLL_SECONDS)
+        job = comm.bcast(job, root=MASTER)
+        if job == 'stop':
+            break
+
+        running, settings = job
+        if taskid == MASTER:
+            print(f'Running job {running.stem}')
+        globals().update(defaults)
+        globals().update(settings)
+        try:
+            main(finalize=False)
+        except Exception as error:
+            # The other processes may be waiting in a collective of this job 
+            # that the failed process never reaches, so the service cannot 
+            # continue with the next job. Record the failure and abort.
+            with open(running.with_suffix('.log'), 'a') as f:
+                f.write(f'Rank {taskid}: {type(error).__name__}: {error}\n')
+            try:
+                running.rename(running.with_suffix('.failed'))
+            except FileNotFoundError:
+                pass                                                    # Renamed by another process
+            print(f'Job {running.stem} failed on rank {taskid}: {error}. Aborting the service.')
+            comm.Abort(1)
+        if taskid == MASTER:
+            running.rename(running.with_suffix('.done'))
+
+    globals().update(defaults)
+    RESIDENT_RESPONSE = None
     MPI.Finalize()
-    
+
+'''
+One process of the 'multiprocessing' backend. The settings of the parent 
+process are applied first, since a spawned process starts from the 
+defaults of this file.
+'''
+def run_process(comm, settings):
+    globals().update(settings)
+    return main(finalize=False, comm=comm)
+
+'''
+Run the solver on the selected BACKEND. Returns the converged M on master 
+(and in the parent process of the 'multiprocessing' backend), None elsewhere.
+'''
+def run(finalize=True):
+    if BACKEND == 'mpi':
+        return main(finalize=finalize)
+    if BACKEND == 'numpy':
+        return main(finalize=False, comm=SerialComm())
+    if BACKEND == 'multiprocessing':
+        settings = {name: value for name, value in globals().items() if name.isupper() and name not in NOT_CONFIGURABLE}
+        return run_processes(run_process, NUM_PROCESSES or os.cpu_count(), args=(settings,))
+    raise ValueError(f"Unknown BACKEND '{BACKEND}'. Use 'mpi', 'numpy' or 'multiprocessing'.")
+
+'''
+Coarse-to-fine deconvolution over RESOLUTION_LEVELS and then RESPONSE_FILE. 
+Every level is solved by run() and warm-started from the previous one. 
+Returns the converged M of the final level (see run()).
+'''
+def run_multiresolution():
+    global RESPONSE_FILE, MAXITER, WARM_START
+    final = {name: globals()[name] for name in ('RESPONSE_FILE', 'MAXITER', 'WARM_START', 'NUMROWS', 'NUMCOLS', 'OUTPUT_FILE', 
+                                                'COMPARE_WITH', 'RUN_REPORT', 'CHECKPOINT_FILE', 'RESUME')}
+    coarse = {'WARM_START': None, 'NUMROWS': None, 'NUMCOLS': None, 'OUTPUT_FILE': None, 'COMPARE_WITH': None, 
+              'RUN_REPORT': None, 'CHECKPOINT_FILE': None, 'RESUME': False}
+    levels = list(RESOLUTION_LEVELS) + [(final['RESPONSE_FILE'], final['MAXITER'])]
+    master = BACKEND != 'mpi' or MPI.COMM_WORLD.Get_rank() == MASTER
+
+    M = parent = None
+    try:
+        for level, (response_file, iterations) in enumerate(levels):
+            last = level == len(levels) - 1
+            globals().update(final if last else coarse)
+            RESPONSE_FILE, MAXITER = response_file, iterations
+            level_parent = load_parent_pixels(filename=response_file)
+            if level > 0 and M is not None:
+                WARM_START = upsample_sky_model(M, parent, level_parent)
+            if master:
+                print(f'Resolution level {level + 1} of {len(levels)}: {response_file}, {iterations} iterations')
+            M = run(finalize=last)
+            parent = level_parent
+    finally:
+        globals().update(final)
+    return M
+
+'''
+Deconvolve ENSEMBLE_SIZE Poisson realizations of d on groups of 
+ENSEMBLE_GROUP_SIZE processes, each group solving every numgroups-th 
+realization. Every group master accumulates the mean and the sum of squared 
+deviations of its maps (Welford), which master combines over the groups. 
+Returns (mean, variance) on master, None elsewhere. Must be called by all 
+processes.
+'''
+def run_ensemble():
+    global RESIDENT_RESPONSE
+    if BACKEND != 'mpi':
+        raise ValueError("ENSEMBLE_SIZE requires BACKEND = 'mpi'.")
+    world = MPI.COMM_WORLD
+    taskid = world.Get_rank()
+    group_size = min(ENSEMBLE_GROUP_SIZE or world.Get_size(), world.Get_size())
+    numgroups = world.Get_size() // group_size
+    group_id = taskid // group_size
+    if taskid == MASTER:
+        print(f'Ensemble of {ENSEMBLE_SIZE} realizations on {numgroups} groups of {group_size} processes')
+        if world.Get_size() % group_size:
+            print(f'{world.Get_size() % group_size} processes are idle. Use a multiple of ENSEMBLE_GROUP_SIZE = {group_size} processes.')
+
+    # Split into the groups. Every group keeps its response slabs and Rj 
+    # resident between its realizations.
+    group = world.Split(group_id if group_id < numgroups else MPI.UNDEFINED, key=taskid)
+    final = {name: globals()[name] for name in ('OUTPUT_FILE', 'COMPARE_WITH', 'RUN_REPORT', 'CHECKPOINT_FILE', 'RESUME')}
+    count, mean, m2 = 0, None, None
+    start = MPI.Wtime()
+    if group != MPI.COMM_NULL:
+        globals().update(OUTPUT_FILE=None, COMPARE_WITH=None, RUN_REPORT=None, CHECKPOINT_FILE=None, RESUME=False)
+        RESIDENT_RESPONSE = {}
+        try:
+            for realization in range(group_id, ENSEMBLE_SIZE, numgroups):
+                M = main(finalize=False, comm=group, realization=realization)
+                if group.Get_rank() == MASTER:
+                    count += 1
+                    if mean is None:
+                        mean, m2 = np.zeros_like(M), np.zeros_like(M)
+                    delta = M - mean
+                    mean += delta / count
+                    m2 += delta * (M - mean)
+                    print(f'Group {group_id}: realization {realization} done')
+        finally:
+            globals().update(final)
+            RESIDENT_RESPONSE = None
+        group.Free()
+
+    # Combine the means and squared deviations of the groups (Chan et al.)
+    stats = world.gather((count, mean, m2), root=MASTER)
+    result = None
+    if taskid == MASTER:
+        count, mean, m2 = 0, 0.0, 0.0
+        for count_g, mean_g, m2_g in stats:
+            if count_g == 0:
+                continue
+            total = count + count_g
+            delta = mean_g - mean
+            mean = mean + delta * count_g / total
+            m2 = m2 + m2_g + delta**2 * count * count_g / total
+            count = total
+        variance = m2 / (count - 1) if count > 1 else np.zeros_like(mean)
+        print(f'Ensemble of {count} realizations finished in {MPI.Wtime() - start:.1f} s')
+        print('Mean M:')
+        print(np.round(mean.T, 5))
+        print('Standard deviation of M:')
+        print(np.round(np.sqrt(variance).T, 5))
+        if ENSEMBLE_OUTPUT is not None:
+            with h5py.File(ENSEMBLE_OUTPUT, 'w') as f1:
+                f1.create_dataset('mean', data=mean)
+                f1.create_dataset('variance', data=variance)
+                f1.attrs['realizations'] = count
+                f1.attrs['group_size'] = group_size
+                f1.attrs['seed'] = ENSEMBLE_SEED
+            print(f'Ensemble mean and variance written to {ENSEMBLE_OUTPUT}')
+        result = (mean, variance)
+
+    MPI.Finalize()
+    return result
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Parallel Richardson-Lucy deconvolution. Without arguments, the settings at the top of this file are used.')
+    parser.add_argument('--config', type=Path, help='YAML configuration file, e.g. deconvolution.yaml')
+    parser.add_argument('--response', help='name of the response in the configuration file')
+    parser.add_argument('--datasets', nargs='+', help='names of the analyses in the configuration file deconvolved together')
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='KEY=VALUE', 
+                        help='override a setting, e.g. --set precision=float32 --set process_grid=[4,2] --set tol_m=1e-6')
+    args = parser.parse_args()
+
+    overrides = args.overrides
+    if args.response is not None:
+        overrides.append(f'response={args.response}')
+    if args.datasets is not None:
+        overrides.append(f'datasets={json.dumps(args.datasets)}')
+    if args.config is not None or overrides:
+        configure(args.config, overrides)
+
+    if SERVICE_SPOOL is not None:
+        serve(SERVICE_SPOOL)
+    elif ENSEMBLE_SIZE:
+        run_ensemble()
+    elif RESOLUTION_LEVELS:
+        run_multiresolution()
+    else:
+        run()
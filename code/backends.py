@@ -0,0 +1,254 @@
+import time
+from abc import ABC, abstractmethod
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+
+# Import third party libraries
+import numpy as np
+
+'''
+Execution backends of RLparallel.py that do not need MPI. LocalComm
+implements the part of the mpi4py communicator interface that the solver
+uses (object and buffer broadcasts, reductions, scatters and gathers) on top
+of in-order point-to-point messages, so that the same main() runs on
+- SerialComm: a single process, where every collective is a copy, and
+- ProcessComm: processes of one node started by run_processes, which
+  exchange their messages through multiprocessing queues.
+Buffers are given as in mpi4py, e.g. [array, MPI.DOUBLE] or
+[array, counts, displacements, MPI.DOUBLE]; the datatype is taken from the
+array itself.
+'''
+
+'''
+Stand-in for the mpi4py.MPI constants used by RLparallel.py, for machines
+without mpi4py. With mpi4py installed, its constants are used instead.
+'''
+class LocalMPI:
+    DOUBLE = 'double'
+    FLOAT = 'float'
+    SUM = 'sum'
+    LAND = 'land'
+    IN_PLACE = 'in_place'
+    UNDEFINED = -32766
+    COMM_TYPE_SHARED = 'shared'
+    COMM_WORLD = None
+
+    @staticmethod
+    def Wtime():
+        return time.perf_counter()
+
+    @staticmethod
+    def Finalize():
+        pass
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = LocalMPI
+
+'''
+Reduction of two values by an mpi4py operation (MPI.SUM or MPI.LAND)
+'''
+def reduce_op(op, a, b):
+    if op is MPI.SUM:
+        return a + b
+    if op is MPI.LAND:
+        return a and b
+    raise ValueError(f'Unsupported reduction {op}. Use MPI.SUM or MPI.LAND.')
+
+'''
+Array, counts and displacements of an mpi4py buffer specification
+'''
+def buffer_spec(spec):
+    if isinstance(spec, (list, tuple)):
+        array = spec[0]
+        counts, displacements = (spec[1], spec[2]) if len(spec) == 4 else (None, None)
+        return array, counts, displacements
+    return spec, None, None
+
+'''
+Base of the local communicators. Subclasses deliver the point-to-point 
+messages (send and recv, in order per source), on which all collectives 
+are built.
+'''
+class LocalComm(ABC):
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    # Point-to-point messages, delivered in order per source
+    @abstractmethod
+    def send(self, obj, dest):
+        pass
+
+    @abstractmethod
+    def recv(self, source):
+        pass
+
+    # Object collectives
+    def bcast(self, obj, root=0):
+        if self.rank == root:
+            for dest in range(self.size):
+                if dest != root:
+                    self.send(obj, dest)
+            return obj
+        return self.recv(root)
+
+    def gather(self, obj, root=0):
+        if self.rank != root:
+            self.send(obj, root)
+            return None
+        return [obj if source == root else self.recv(source) for source in range(self.size)]
+
+    def allgather(self, obj):
+        return self.bcast(self.gather(obj, root=0), root=0)
+
+    def reduce(self, obj, op=MPI.SUM, root=0):
+        values = self.gather(obj, root=root)
+        if values is None:
+            return None
+        result = values[0]
+        for value in values[1:]:
+            result = reduce_op(op, result, value)
+        return result
+
+    def allreduce(self, obj, op=MPI.SUM):
+        return self.bcast(self.reduce(obj, op=op, root=0), root=0)
+
+    def Barrier(self):
+        self.allreduce(None, op=MPI.LAND)
+
+    # Buffer collectives. Arrays are summed in rank order, so every run on
+    # the same number of processes gives the same result.
+    def Bcast(self, buf, root=0):
+        array, _, _ = buffer_spec(buf)
+        data = self.bcast(array if self.rank == root else None, root=root)
+        if self.rank != root:
+            array[...] = data
+
+    def Reduce(self, sendbuf, recvbuf, op=MPI.SUM, root=0):
+        array, _, _ = buffer_spec(sendbuf)
+        result = self.reduce(np.array(array), op=op, root=root)
+        if self.rank == root:
+            buffer_spec(recvbuf)[0][...] = result
+
+    def Allreduce(self, sendbuf, recvbuf, op=MPI.SUM):
+        target, _, _ = buffer_spec(recvbuf)
+        array = target if sendbuf is MPI.IN_PLACE else buffer_spec(sendbuf)[0]
+        target[...] = self.allreduce(np.array(array), op=op)
+
+    def Scatterv(self, sendbuf, recvbuf, root=0):
+        target, _, _ = buffer_spec(recvbuf)
+        if self.rank == root:
+            array, counts, displacements = buffer_spec(sendbuf)
+            flat = np.asarray(array).reshape(-1)
+            for dest in range(self.size):
+                block = flat[displacements[dest]:displacements[dest] + counts[dest]]
+                if dest == root:
+                    target.reshape(-1)[...] = block
+                else:
+                    self.send(block, dest)
+        else:
+            target.reshape(-1)[...] = self.recv(root)
+
+    def Gatherv(self, sendbuf, recvbuf, root=0):
+        blocks = self.gather(np.array(buffer_spec(sendbuf)[0]).reshape(-1), root=root)
+        if self.rank == root:
+            array, counts, displacements = buffer_spec(recvbuf)
+            flat = array.reshape(-1)
+            for block, count, displacement in zip(blocks, counts, displacements):
+                flat[displacement:displacement + count] = block
+
+    def Allgatherv(self, sendbuf, recvbuf):
+        self.Gatherv(sendbuf, recvbuf, root=0)
+        self.Bcast(recvbuf, root=0)
+
+    # All processes of a local backend share one node
+    def Split_type(self, split_type, key=0):
+        return self
+
+    def Free(self):
+        pass
+
+'''
+Communicator of a single process
+'''
+class SerialComm(LocalComm):
+    def __init__(self):
+        super().__init__(0, 1)
+        self.messages = deque()
+
+    def send(self, obj, dest):
+        self.messages.append(obj)
+
+    def recv(self, source):
+        return self.messages.popleft()
+
+'''
+Communicator of one of the processes started by run_processes. queues[r]
+holds the messages sent to rank r as (source, message). Messages that
+arrive from other sources while waiting are kept until they are received.
+'''
+class ProcessComm(LocalComm):
+    def __init__(self, rank, size, queues):
+        super().__init__(rank, size)
+        self.queues = queues
+        self.pending = [deque() for source in range(size)]
+
+    def send(self, obj, dest):
+        self.queues[dest].put((self.rank, obj))
+
+    def recv(self, source):
+        while not self.pending[source]:
+            sender, obj = self.queues[self.rank].get()
+            self.pending[sender].append(obj)
+        return self.pending[source].popleft()
+
+def process_main(target, rank, size, queues, connection, args):
+    result = target(ProcessComm(rank, size, queues), *args)
+    if rank == 0:
+        connection.send(result)
+    connection.close()
+
+'''
+Run target(comm, *args) on numprocs processes of this node and return the
+result of rank 0. If a process fails, the others are terminated and a
+RuntimeError is raised.
+'''
+def run_processes(target, numprocs, args=()):
+    context = multiprocessing.get_context()
+    queues = [context.Queue() for rank in range(numprocs)]
+    receiver, sender = context.Pipe(duplex=False)
+    processes = [context.Process(target=process_main, args=(target, rank, numprocs, queues, sender, args))
+                 for rank in range(numprocs)]
+    for process in processes:
+        process.start()
+    sender.close()
+
+    # Wait for the result of rank 0 while watching for failed processes
+    result = None
+    ranks = {process.sentinel: rank for rank, process in enumerate(processes)}
+    waiting = [receiver] + list(ranks)
+    while waiting:
+        for ready in wait(waiting):
+            waiting.remove(ready)
+            if ready is receiver:
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    pass
+                continue
+            process = processes[ranks[ready]]
+            process.join()
+            if process.exitcode != 0:
+                for other in processes:
+                    other.terminate()
+                raise RuntimeError(f'Rank {ranks[ready]} of the multiprocessing backend exited with code {process.exitcode}.')
+    return result
@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+# Import third party libraries
+import numpy as np
+import h5py
+
+from sparseresponse import CreateSparseResponse, AppendSparseRows
+
+FILE_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
+
+# File names written by the generator. The data and background files follow
+# the "contents" layout of the *_dense.h5 files read by RLparallel.py.
+RESPONSE_FILE = 'response_flattened_synthetic.h5'
+SIGNAL_FILE = 'signal_synthetic_dense.h5'
+BKG_FILE = 'bkg_synthetic_dense.h5'
+
+# Header of the scaling tables. The first five columns match
+# outputs/speedup_expanse.txt, where "Nodes" is the number of MPI ranks.
+TABLE_HEADER = 'Data, Stripelength, Nodes, Iterations, Time, Load, Iterate, Speedup, Efficiency'
+
+'''
+Synthetic response matrix. Writes a NUMROWS x NUMCOLS response with the given
+fraction of nonzeros in row blocks, so that the full 184320x3072 shape never
+has to fit in memory, together with the summed response_vector, the nonzero
+profiles row_nnz and col_nnz, and Poisson data from a few point sources on top
+of a flat background.
+'''
+def generate_synthetic_problem(workdir, numrows, numcols, density=0.1, response_format='dense',
+                               block_rows=8192, seed=0):
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # Injected sky: a handful of point sources
+    M_true = np.zeros(numcols)
+    M_true[rng.choice(numcols, size=min(3, numcols), replace=False)] = rng.uniform(10, 100, size=min(3, numcols))
+    bkg = rng.uniform(0.1, 1.0, size=numrows)
+    d = np.empty(numrows)
+    response_vector = np.zeros(numcols)
+    row_nnz = np.empty(numrows, dtype=np.int64)
+    col_nnz = np.zeros(numcols, dtype=np.int64)
+
+    with h5py.File(workdir / RESPONSE_FILE, 'w') as f:
+        if response_format == 'csr':
+            group = CreateSparseResponse(f, (numrows, numcols), np.float64)
+            nnz = 0
+        elif response_format == 'dense':
+            dset = f.create_dataset('response_matrix', shape=(numrows, numcols), dtype=np.float64,
+                                    chunks=(min(block_rows, numrows), numcols))
+        else:
+            raise ValueError(f"Unknown response format '{response_format}'. Use 'dense' or 'csr'.")
+
+        for start in range(0, numrows, block_rows):
+            end = min(start + block_rows, numrows)
+            block = rng.random((end - start, numcols))
+            block[rng.random((end - start, numcols)) >= density] = 0.
+            response_vector += block.sum(axis=0)
+            row_nnz[start:end] = np.count_nonzero(block, axis=1)
+            col_nnz += np.count_nonzero(block, axis=0)
+            d[start:end] = rng.poisson(block @ M_true + bkg[start:end])
+
+            if response_format == 'csr':
+                nnz = AppendSparseRows(group, start, block, nnz)
+            else:
+                dset[start:end] = block
+
+        f.create_dataset('response_vector', data=response_vector)
+        f.create_dataset('row_nnz', data=row_nnz)
+        f.create_dataset('col_nnz', data=col_nnz)
+
+    # RLparallel.py forms d = signal + bkg
+    with h5py.File(workdir / SIGNAL_FILE, 'w') as f:
+        f.create_dataset('contents', data=d - bkg)
+    with h5py.File(workdir / BKG_FILE, 'w') as f:
+        f.create_dataset('contents', data=bkg)
+
+    return workdir
+
+'''
+Run RLparallel.run() in this process on a synthetic problem. Meant to be
+launched by run_solver(), under mpiexec for the 'mpi' backend.
+'''
+def solve(workdir, numrows, numcols, iterations, response_format, report, threads=None, thread_backend='blas',
+          backend='mpi', processes=None):
+    import RLparallel as rl
+    rl.NUMROWS = numrows
+    rl.NUMCOLS = numcols
+    rl.MAXITER = iterations
+    rl.DATA_DIR = Path(workdir)
+    rl.BASE_DIR = Path(workdir)
+    rl.RESPONSE_FILE = RESPONSE_FILE
+    rl.RESPONSE_FORMAT = response_format
+    rl.DATASETS = [([SIGNAL_FILE], BKG_FILE)]
+    rl.RUN_REPORT = report
+    rl.THREADS_PER_RANK = threads
+    rl.THREAD_BACKEND = thread_backend
+    rl.BACKEND = backend
+    rl.NUM_PROCESSES = processes
+    rl.run()
+
+'''
+Launch the solver on numtasks ranks (or processes of a local backend) and 
+return its run report summary
+'''
+def run_solver(mpiexec, numtasks, workdir, numrows, numcols, iterations, response_format, threads=None, thread_backend='blas',
+               backend='mpi'):
+    report = Path(workdir) / f'run_report_n{numtasks}'
+    command = [sys.executable, str(Path(__file__).resolve()), 'solve',
+               '--workdir', str(workdir), '--rows', str(numrows), '--cols', str(numcols),
+               '--iterations', str(iterations), '--format', response_format, '--report', str(report),
+               '--thread-backend', thread_backend, '--backend', backend, '--processes', str(numtasks)]
+    if backend == 'mpi':
+        command = mpiexec.split() + ['-n', str(numtasks)] + command
+    if threads is not None:
+        command += ['--threads', str(threads)]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=FILE_DIR)
+    with open(report.with_suffix('.json')) as f:
+        return json.load(f)
+
+'''
+Total setup (load) and iteration time of a run report summary
+'''
+def split_times(summary):
+    setup = sum(phase['seconds_max'] for name, phase in summary['phases'].items() if name.startswith(('load', 'bcast_data', 'scatter_data', 'reduce_Rj')))
+    return setup, summary['elapsed_seconds'] - setup
+
+'''
+Scaling table rows in the format of outputs/speedup_expanse.txt with the
+load/iteration split, speedup and parallel efficiency relative to the first
+rank count appended. For weak scaling the ideal time is constant.
+'''
+def scaling_table(label, summaries, weak=False):
+    lines = [TABLE_HEADER]
+    reference = None
+    for summary in summaries:
+        numtasks = summary['numtasks']
+        time = summary['elapsed_seconds']
+        load, iterate = split_times(summary)
+        if reference is None:
+            reference = (numtasks, time)
+        speedup = reference[1] / time
+        efficiency = speedup if weak else speedup * reference[0] / numtasks
+        lines.append(f'{label}, 1, {numtasks}, {summary["iterations"]}, {time:.3f}, {load:.3f}, {iterate:.3f}, {speedup:.2f}, {efficiency:.2f}')
+    return '\n'.join(lines)
+
+'''
+Compare a scaling table against a baseline table and return the rows whose
+time regressed by more than the tolerance
+'''
+def find_regressions(table, baseline_file, tolerance):
+    def times(lines):
+        rows = [line.split(', ') for line in lines[1:] if line.strip()]
+        return {(row[0], int(row[2])): float(row[4]) for row in rows}
+    with open(baseline_file) as f:
+        baseline = times(f.read().splitlines())
+    current = times(table.splitlines())
+    return [(key, baseline[key], time) for key, time in current.items()
+            if key in baseline and baseline[key] > 0 and time > baseline[key] * (1 + tolerance)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Strong and weak scaling benchmarks of RLparallel.py on synthetic responses.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_problem_arguments(subparser, rows_help):
+        subparser.add_argument('--cols', type=int, default=3072, help='number of sky pixels (NUMCOLS)')
+        subparser.add_argument('--density', type=float, default=0.1, help='fraction of nonzero response entries')
+        subparser.add_argument('--format', choices=['dense', 'csr'], default='dense', help='response storage format')
+        subparser.add_argument('--workdir', type=Path, default=Path('/tmp/rl_benchmark'), help='directory for the synthetic files')
+        subparser.add_argument('--rows', type=int, default=184320, help=rows_help)
+
+    subparser = subparsers.add_parser('generate', help='write a synthetic problem')
+    add_problem_arguments(subparser, 'number of data-space bins (NUMROWS)')
+
+    for name, rows_help in (('strong', 'number of data-space bins (NUMROWS)'),
+                            ('weak', 'number of data-space bins per rank')):
+        subparser = subparsers.add_parser(name, help=f'{name} scaling benchmark')
+        add_problem_arguments(subparser, rows_help)
+        subparser.add_argument('--ranks', type=int, nargs='+', default=[1, 2, 4, 8], help='MPI rank counts')
+        subparser.add_argument('--iterations', type=int, default=50, help='RL iterations (MAXITER)')
+        subparser.add_argument('--mpiexec', default='mpiexec', help='MPI launcher, e.g. "mpiexec --oversubscribe"')
+        subparser.add_argument('--output', type=Path, help='write the scaling table to this file')
+        subparser.add_argument('--baseline', type=Path, help='fail if a time exceeds this table by more than --tolerance')
+        subparser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown against --baseline')
+        subparser.add_argument('--threads', help='threads per rank (THREADS_PER_RANK), an integer or "auto"')
+        subparser.add_argument('--thread-backend', choices=['blas', 'pool'], default='blas', help='THREAD_BACKEND of the threads per rank')
+        subparser.add_argument('--backend', choices=['mpi', 'numpy', 'multiprocessing'], default='mpi',
+                               help='execution backend (BACKEND). --ranks sets the number of processes of multiprocessing.')
+
+    subparser = subparsers.add_parser('solve', help=argparse.SUPPRESS)
+    subparser.add_argument('--workdir', type=Path, required=True)
+    subparser.add_argument('--rows', type=int, required=True)
+    subparser.add_argument('--cols', type=int, required=True)
+    subparser.add_argument('--iterations', type=int, required=True)
+    subparser.add_argument('--format', required=True)
+    subparser.add_argument('--report', type=Path, required=True)
+    subparser.add_argument('--threads')
+    subparser.add_argument('--thread-backend', default='blas')
+    subparser.add_argument('--backend', default='mpi')
+    subparser.add_argument('--processes', type=int)
+
+    args = parser.parse_args()
+
+    if args.command == 'solve':
+        threads = args.threads if args.threads in (None, 'auto') else int(args.threads)
+        solve(args.workdir, args.rows, args.cols, args.iterations, args.format, args.report, threads, args.thread_backend,
+              args.backend, args.processes)
+        return 0
+
+    if args.command == 'generate':
+        generate_synthetic_problem(args.workdir, args.rows, args.cols, args.density, args.format)
+        print(f'Synthetic {args.rows}x{args.cols} problem written to {args.workdir}')
+        return 0
+
+    if args.backend == 'numpy' and args.ranks != [1]:
+        parser.error("The 'numpy' backend runs a single process. Use --ranks 1.")
+
+    # Strong scaling solves one problem on every rank count. Weak scaling
+    # regenerates the problem with rows proportional to the rank count.
+    summaries = []
+    for numtasks in args.ranks:
+        numrows = args.rows * numtasks if args.command == 'weak' else args.rows
+        if args.command == 'weak' or not summaries:
+            generate_synthetic_problem(args.workdir, numrows, args.cols, args.density, args.format)
+        summary = run_solver(args.mpiexec, numtasks, args.workdir, numrows, args.cols, args.iterations, args.format,
+                             args.threads, args.thread_backend, args.backend)
+        print(f'{numtasks} ranks: {summary["elapsed_seconds"]:.3f} s')
+        summaries.append(summary)
+
+    label = f'synthetic{args.rows}x{args.cols}{"_csr" if args.format == "csr" else ""}{"_weak" if args.command == "weak" else ""}'
+    if args.threads is not None:
+        label += f'_t{args.threads}{args.thread_backend}'
+    if args.backend != 'mpi':
+        label += f'_{args.backend}'
+    table = scaling_table(label, summaries, weak=args.command == 'weak')
+    print(table)
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(table + '\n')
+
+    if args.baseline is not None:
+        regressions = find_regressions(table, args.baseline, args.tolerance)
+        for (data, numtasks), before, after in regressions:
+            print(f'Regression: {data} on {numtasks} ranks took {after:.3f} s, baseline {before:.3f} s')
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,10 @@
 import os
+import gzip
+import shutil
+import hashlib
+import zipfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import numpy as np
 import h5py
@@ -9,10 +14,93 @@ import healpy as hp
 from cosipy import BinnedData
 from cosipy.util import fetch_wasabi_file
 
+from sparseresponse import CreateSparseResponse, AppendSparseRows
+
 # FILE_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 FILE_DIR = Path('/Users/penguin/Documents/Grad School/Research/COSI/COSIpy/docs/tutorials/44Ti')
 DATA_DIR = Path('/Users/penguin/Documents/Grad School/Research/COSI/COSIpy/docs/tutorials/data')
 WASABI_DIR = Path('COSI-SMEX/DC2')
+SNe = ['CasA', 'G1903', 'SN1987A', 'SNsurprise']
+
+# Existing files are checked against the size and modification time 
+# recorded with their checksum. With VERIFY_CHECKSUMS, their SHA-256 is 
+# recomputed instead, which reads every file in full. main() turns it on to 
+# recover from an interrupted run.
+VERIFY_CHECKSUMS = False
+
+def PartialFile(path):
+    # Every output is first written to path.partial and only moved to path 
+    # by CommitFile once it is complete, so an interrupted run never leaves 
+    # a truncated file behind under the final name.
+    return path.with_name(path.name + '.partial')
+
+def ChecksumFile(path):
+    return path.with_name(path.name + '.sha256')
+
+def FileChecksum(path, block_size=1 << 20):
+    # SHA-256 of a file, read block_size bytes at a time
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def RecordChecksum(path, checksum, stat):
+    # path.sha256 holds the checksum (sha256sum format) and the size and 
+    # modification time of the file it was computed from
+    ChecksumFile(path).write_text(f'{checksum}  {path.name}\n# size {stat.st_size} mtime_ns {stat.st_mtime_ns}\n')
+
+def CommitFile(partial_file, path):
+    # Record the checksum of a fully written partial_file in path.sha256 
+    # and atomically rename it to path (which keeps its size and mtime)
+    RecordChecksum(path, FileChecksum(partial_file), partial_file.stat())
+    os.replace(partial_file, path)
+    return path
+
+def IsComplete(path, verify=None):
+    # Does path exist and match its recorded checksum? Files without a 
+    # checksum, e.g. downloaded by hand, are taken as complete. Unless 
+    # verify (default VERIFY_CHECKSUMS), a file with the recorded size and 
+    # modification time is not read again.
+    if not path.is_file():
+        return False
+    if not ChecksumFile(path).is_file():
+        return True
+    verify = VERIFY_CHECKSUMS if verify is None else verify
+    recorded = ChecksumFile(path).read_text().splitlines()
+    stat = path.stat()
+    if not verify and recorded[1:2] == [f'# size {stat.st_size} mtime_ns {stat.st_mtime_ns}']:
+        return True
+    checksum = FileChecksum(path)
+    if recorded and recorded[0].split()[0] == checksum:
+        RecordChecksum(path, checksum, stat)
+        return True
+    print(f'{path.name} does not match its checksum. Recreating it.')
+    return False
+
+def SetVerifyChecksums(verify):
+    # Initializer of the process pools, which may not inherit the globals
+    global VERIFY_CHECKSUMS
+    VERIFY_CHECKSUMS = verify
+
+def Decompress(compressed_file, path, block_size=1 << 20):
+    # Stream a .gz or .zip archive into path without holding it in memory, 
+    # then remove the archive as gunzip does
+    partial_file = PartialFile(path)
+    with open(partial_file, 'wb') as target:
+        if compressed_file.suffix == '.zip':
+            with zipfile.ZipFile(compressed_file) as archive:
+                names = archive.namelist()
+                if path.name not in names and len(names) != 1:
+                    raise ValueError(f'{compressed_file.name} does not contain {path.name}.')
+                with archive.open(path.name if path.name in names else names[0]) as source:
+                    shutil.copyfileobj(source, target, block_size)
+        else:
+            with gzip.open(compressed_file, 'rb') as source:
+                shutil.copyfileobj(source, target, block_size)
+    CommitFile(partial_file, path)
+    compressed_file.unlink()
+    return 0
 
 def FileExists(datapath, filename='Ti44_CasA_3months_unbinned_data.fits', wasabi_path=WASABI_DIR / 'Data/Sources/'):
     # Does datapath exist?
@@ -23,41 +111,42 @@ def FileExists(datapath, filename='Ti44_CasA_3months_unbinned_data.fits', wasabi
         return 1
     
     # Does file exist?
-    if (datapath / filename).is_file():
+    if IsComplete(datapath / filename):
         print(f'{filename} exists in datapath.')
 
     elif (datapath / f'{filename}.gz').is_file():
-        print(f'{filename} does not exist in file path but a .gz compressed version does. Untarring...')
-        os.system('gunzip ' + str(datapath / f'{filename}.gz'))
+        print(f'{filename} does not exist in file path but a .gz compressed version does. Decompressing...')
+        Decompress(datapath / f'{filename}.gz', datapath / filename)
 
     elif (datapath / f'{filename}.zip').is_file():
         print(f'{filename} does not exist in file path but a .zip compressed version does. Unzipping...')
-        os.system('gunzip ' + str(datapath / f'{filename}.zip'))
+        Decompress(datapath / f'{filename}.zip', datapath / filename)
 
     else:
+        # Download next to the archive and rename, so that an interrupted 
+        # download is fetched again rather than decompressed
         print(f'{filename} does not exist in datapath. Fetching from wasabi.')
-        fetch_wasabi_file(str(wasabi_path / f'{filename}.gz'), output=str(datapath / f'{filename}.gz'))
-        os.system('gunzip ' + str(datapath / f'{filename}.gz'))
+        download = PartialFile(datapath / f'{filename}.gz')
+        download.unlink(missing_ok=True)
+        fetch_wasabi_file(str(wasabi_path / f'{filename}.gz'), output=str(download))
+        os.replace(download, datapath / f'{filename}.gz')
+        Decompress(datapath / f'{filename}.gz', datapath / filename)
 
     print()
     return 0
 
-def FileCheck():
-    # Checking source files
-    SNe = ['CasA', 'G1903', 'SN1987A', 'SNsurprise']
-    for SN in SNe:
-        FileExists(datapath=DATA_DIR, filename=f'Ti44_{SN}_3months_unbinned_data.fits', 
-                    wasabi_path=WASABI_DIR / 'Data/Sources/')
-    
-    # Checking background file
-    FileExists(datapath=DATA_DIR, filename='total_bg_3months_unbinned_data.fits', 
-              wasabi_path=WASABI_DIR / 'Data/Backgrounds/')
-    
-    # Checking response file
-    FileExists(datapath=DATA_DIR, filename='psr_gal_Ti44_E_1150_1164keV_DC2.h5',
-               wasabi_path=WASABI_DIR / 'Responses/PointSourceReponse/')
+def FileCheck(max_workers=None):
+    # The downloads and decompressions are independent and I/O bound, so 
+    # the files are checked concurrently on max_workers threads
+    files = [(f'Ti44_{SN}_3months_unbinned_data.fits', WASABI_DIR / 'Data/Sources/') for SN in SNe]      # source files
+    files.append(('total_bg_3months_unbinned_data.fits', WASABI_DIR / 'Data/Backgrounds/'))               # background file
+    files.append(('psr_gal_Ti44_E_1150_1164keV_DC2.h5', WASABI_DIR / 'Responses/PointSourceReponse/'))   # response file
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(FileExists, datapath=DATA_DIR, filename=filename, wasabi_path=wasabi_path) 
+                   for filename, wasabi_path in files]
     
-    return 0
+    return max(future.result() for future in futures)
 
 def GetBinnedData(config_file=FILE_DIR / 'input.yaml', parent_file=FILE_DIR / 'data/Ti44_CasA_3months_unbinned_data.fits', 
               output_file=FILE_DIR / 'data/Ti44_CasA_binned'):
@@ -68,44 +157,90 @@ def GetBinnedData(config_file=FILE_DIR / 'input.yaml', parent_file=FILE_DIR / 'd
     
     return 0
 
-def Derived_FilesCheck():
-    # Checking binned source files
-    SNe = ['CasA', 'G1903', 'SN1987A', 'SNsurprise']
-    for SN in SNe:
-        filename = f'data/Ti44_{SN}_binned.hdf5'
-        if not (FILE_DIR / filename).is_file():
-            print(f'{filename} does not exist. Deriving from vanilla file.')
-            GetBinnedData(parent_file = DATA_DIR / f'Ti44_{SN}_3months_unbinned_data.fits', 
-                    output_file = FILE_DIR / f'data/Ti44_{SN}_binned')
-            binned_signal = Histogram.open(FILE_DIR / filename)
-            signal = np.sum(binned_signal.to_dense().contents, axis=0).flatten()
-            with h5py.File(FILE_DIR / f'data/Ti44_{SN}_dense.hdf5', 'w') as hf:
-                dset = hf.create_dataset('contents', data=signal)
-        else:
-            print(f'{filename} exists')
-            print()
+def SumOverTime(histogram):
+    # Sum the binned histogram over axis 0 (time) and flatten the rest. 
+    # A sparse histogram is reduced in its sparse form and only the summed 
+    # (time-independent) contents are densified.
+    summed = histogram.contents.sum(axis=0)
+    if hasattr(summed, 'todense'):
+        summed = summed.todense()
+    return np.asarray(summed).flatten()
+
+def DerivedFile(parent_file, binned_file, dense_file):
+    # Bin parent_file into binned_file and write its sum over time to the 
+    # 'contents' dataset of dense_file. Complete files from an earlier, 
+    # possibly interrupted run are reused. Runs in a worker process of 
+    # Derived_FilesCheck.
+    if IsComplete(dense_file):
+        print(f'{dense_file.name} exists')
+        return dense_file
+
+    if not IsComplete(binned_file):
+        print(f'{binned_file.name} does not exist. Deriving from vanilla file.')
+        # BinnedData appends the .hdf5 suffix to output_name
+        partial_file = binned_file.with_suffix('.partial')
+        GetBinnedData(parent_file=parent_file, output_file=partial_file)
+        CommitFile(partial_file.with_suffix('.partial.hdf5'), binned_file)
+
+    binned = Histogram.open(binned_file)
+    partial_file = PartialFile(dense_file)
+    with h5py.File(partial_file, 'w') as hf:
+        dset = hf.create_dataset('contents', data=SumOverTime(binned))
+    return CommitFile(partial_file, dense_file)
+
+def Derived_FilesCheck(pool=None, max_workers=None):
+    # The sources and the background are binned in parallel, one per 
+    # process of pool (or of a new pool of max_workers processes)
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=SetVerifyChecksums, initargs=(VERIFY_CHECKSUMS,)) as pool:
+            return Derived_FilesCheck(pool=pool)
+
+    # Binned source files
+    files = [(DATA_DIR / f'Ti44_{SN}_3months_unbinned_data.fits', FILE_DIR / f'data/Ti44_{SN}_binned.hdf5', 
+              FILE_DIR / f'data/Ti44_{SN}_dense.hdf5') for SN in SNe]
     
-    # Checking binned background file
-    filename = 'total_bg_binned_phi3.hdf5'
-    if not (DATA_DIR / filename).is_file():
-        print(f'{filename} does not exist. Deriving from vanilla file.')
-        GetBinnedData(parent_file = DATA_DIR / 'total_bg_3months_unbinned_data.fits', 
-                  output_file = DATA_DIR / 'total_bg_binned_phi3')
-        binned_bkg = Histogram.open(DATA_DIR / filename)
-        bkg = np.sum(binned_bkg.to_dense().contents, axis=0).flatten()
-        with h5py.File(FILE_DIR / 'data/total_bg_dense.hdf5', 'w') as hf:
-            dset = hf.create_dataset('contents', data=bkg)
-    else:
-        print(f'{filename} exists')
-        print()
+    # Binned background file
+    files.append((DATA_DIR / 'total_bg_3months_unbinned_data.fits', DATA_DIR / 'total_bg_binned_phi3.hdf5', 
+                  FILE_DIR / 'data/total_bg_dense.hdf5'))
+
+    futures = [pool.submit(DerivedFile, *file) for file in files]
+    for future in as_completed(futures):
+        print(f'{future.result().name} is ready')
+    print()
         
     return 0
 
 def FormattedResponse_FilesCheck(response_file = 'psr_gal_Ti44_E_1150_1164keV_DC2.h5', 
-                                 flattened_response_file = 'psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5'):
-    # Checking flattened response file
-    if not (DATA_DIR / flattened_response_file).is_file():
-        print(f'{flattened_response_file} flattened response file does not exist. Creating from raw file.')
+                                 flattened_response_file = 'psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5',
+                                 response_format = 'dense', block_rows = 4096, chunk_rows = 128, comm = None, 
+                                 response_dtype = None):
+    # response_format: 'dense' writes the 'response_matrix' dataset, 'csr' 
+    # writes the 'response_matrix_csr' group instead (see CreateSparseResponse).
+    # The raw histogram is flattened in blocks of about block_rows rows of the 
+    # flattened matrix (whole Phi bins), so it never has to fit in memory, and 
+    # 'response_vector' is accumulated in the same pass, together with the 
+    # nonzero profiles 'row_nnz' and 'col_nnz' that RLparallel.py uses to 
+    # balance its partition (PARTITION = 'nnz'). The dense dataset is 
+    # chunked in full-width blocks of chunk_rows rows to match the row slab 
+    # reads of RLparallel.py. response_dtype sets the storage type of the 
+    # flattened response, e.g. np.float32 for PRECISION = 'float32' in 
+    # RLparallel.py (default: that of the raw file). 'response_vector' is 
+    # always summed in float64. If an MPI communicator comm is given, the 
+    # blocks are distributed round-robin over its processes and written 
+    # through parallel HDF5 (dense only), e.g. 
+    # mpiexec -n 8 python -c "from mpi4py import MPI; import datapreprocessing as dp; dp.FormattedResponse_FilesCheck(comm=MPI.COMM_WORLD)"
+    taskid, numtasks = (0, 1) if comm is None else (comm.Get_rank(), comm.Get_size())
+    if comm is not None and response_format == 'csr':
+        raise ValueError("Parallel flattening only supports response_format = 'dense'.")
+
+    # Checking flattened response file. It is written to a partial file 
+    # first, so a run interrupted while flattening starts over.
+    exists = IsComplete(DATA_DIR / flattened_response_file) if taskid == 0 else None
+    if comm is not None:
+        exists = comm.bcast(exists, root=0)
+    if not exists:
+        if taskid == 0:
+            print(f'{flattened_response_file} flattened response file does not exist. Creating from raw file.')
 
         # Open parent file
         hf = h5py.File(DATA_DIR / response_file, 'r')
@@ -117,28 +252,146 @@ def FormattedResponse_FilesCheck(response_file = 'psr_gal_Ti44_E_1150_1164keV_DC
         NUMROWS = np.prod(np.array(old_shape[:2]) - 2)
         NUMCOLS = np.prod(np.array(old_shape[2:]) - 2)
         new_shape = (NUMCOLS, NUMROWS)
+        dtype = dset.dtype if response_dtype is None else np.dtype(response_dtype)
+
+        # Each Phi bin contributes a contiguous block of PsiChi rows
+        num_phi = old_shape[3] - 2
+        rows_per_phi = old_shape[4] - 2
+        phi_block = max(1, block_rows // rows_per_phi)
 
         # Create flatted response file
-        with h5py.File(DATA_DIR / flattened_response_file, 'w') as output_file:
-            dset1 = output_file.create_dataset('response_matrix', data=np.transpose(dset[1:-1, 1, 1, 1:-1, 1:-1], (1,2, 0)).reshape(new_shape))
-            print(dset1.shape)
-            dset2 = output_file.create_dataset('response_vector', data=np.sum(dset1, axis=0))
-            print(dset2.shape)
+        parallel = {} if comm is None else {'driver': 'mpio', 'comm': comm}
+        partial_file = PartialFile(DATA_DIR / flattened_response_file)
+        with h5py.File(partial_file, 'w', **parallel) as output_file:
+            if response_format == 'csr':
+                csr_group = CreateSparseResponse(output_file, new_shape, dtype)
+                nnz = 0
+            else:
+                dset1 = output_file.create_dataset('response_matrix', shape=new_shape, dtype=dtype, 
+                                                   chunks=(min(chunk_rows, new_shape[0]), new_shape[1]))
+            dset2 = output_file.create_dataset('response_vector', shape=(new_shape[1],), dtype=np.float64)
+            response_vector = np.zeros(new_shape[1])
+            dset3 = output_file.create_dataset('row_nnz', shape=(new_shape[0],), dtype=np.int64)
+            dset4 = output_file.create_dataset('col_nnz', shape=(new_shape[1],), dtype=np.int64)
+            col_nnz = np.zeros(new_shape[1], dtype=np.int64)
+
+            for block_id, phi_start in enumerate(range(0, num_phi, phi_block)):
+                if block_id % numtasks != taskid:
+                    continue
+                phi_end = min(phi_start + phi_block, num_phi)
+                block = np.transpose(dset[1:-1, 1, 1, 1 + phi_start:1 + phi_end, 1:-1], (1,2, 0)).reshape(-1, new_shape[1])
+                start_row = phi_start * rows_per_phi
+                if response_format == 'csr':
+                    nnz = AppendSparseRows(csr_group, start_row, block.astype(dtype, copy=False), nnz)
+                else:
+                    dset1[start_row:start_row + block.shape[0]] = block.astype(dtype, copy=False)
+                response_vector += np.sum(block, axis=0, dtype=np.float64)
+                dset3[start_row:start_row + block.shape[0]] = np.count_nonzero(block, axis=1)
+                col_nnz += np.count_nonzero(block, axis=0)
+
+            if comm is not None:
+                response_vector = comm.allreduce(response_vector)
+                col_nnz = comm.allreduce(col_nnz)
+            if taskid == 0:
+                dset2[:] = response_vector
+                dset4[:] = col_nnz
+                if response_format == 'csr':
+                    print(f'CSR response: {nnz} nonzeros ({nnz / np.prod(new_shape):.2%} of {new_shape[0]}x{new_shape[1]})')
+                else:
+                    print(dset1.shape)
+                print(dset2.shape)
 
         # Close parent file
         hf.close()
+        if taskid == 0:
+            CommitFile(partial_file, DATA_DIR / flattened_response_file)
+        if comm is not None:
+            comm.Barrier()
 
-    else:
+    elif taskid == 0:
         print(f'{flattened_response_file} flattened response file exists')
         print()
 
     return 0
 
-def main():
+def DowngradedResponse_FilesCheck(flattened_response_file = 'psr_gal_flattened_Ti44_E_1150_1164keV_DC2.h5', 
+                                  nside_out = 8, scheme = 'ring', block_rows = 4096, chunk_rows = 128):
+    # Write the flattened response at the lower HEALPix resolution nside_out 
+    # to <flattened_response_file stem>_nside<nside_out>.h5 for the coarse 
+    # levels of RESOLUTION_LEVELS in RLparallel.py. The sky pixels (columns) 
+    # of every coarse pixel are summed, in blocks of block_rows rows, so 
+    # that R_coarse @ M = R @ M for M constant over the child pixels. The 
+    # 'parent_pixel' dataset holds the coarse pixel of every pixel of the 
+    # input response, with which RLparallel.py upsamples the coarse M. 
+    # scheme is the HEALPix ordering of the sky pixels ('ring' or 'nested').
+    downgraded_file = DATA_DIR / f'{Path(flattened_response_file).stem}_nside{nside_out}.h5'
+    if IsComplete(downgraded_file):
+        print(f'{downgraded_file.name} downgraded response file exists')
+        print()
+        return 0
+    print(f'{downgraded_file.name} downgraded response file does not exist. Creating from {flattened_response_file}.')
+
+    with h5py.File(DATA_DIR / flattened_response_file, 'r') as input_file:
+        if 'response_matrix' not in input_file:
+            raise ValueError(f"{flattened_response_file} has no dense 'response_matrix'. Flatten it with response_format='dense'.")
+        dset = input_file['response_matrix']
+        numrows, numcols = dset.shape
+        nside_in = hp.npix2nside(numcols)
+        if nside_out > nside_in or nside_in % nside_out:
+            raise ValueError(f'Cannot downgrade nside {nside_in} to {nside_out}.')
+
+        # Coarse pixel of every pixel, through the nested ordering, where the 
+        # children of a pixel are consecutive
+        pixels = np.arange(numcols)
+        nested = hp.ring2nest(nside_in, pixels) if scheme == 'ring' else pixels
+        parent_nested = nested // (nside_in // nside_out) ** 2
+        parent = hp.nest2ring(nside_out, parent_nested) if scheme == 'ring' else parent_nested
+        numcols_out = hp.nside2npix(nside_out)
+        order = np.argsort(parent, kind='stable')
+        children = np.searchsorted(parent[order], np.arange(numcols_out))
+
+        partial_file = PartialFile(downgraded_file)
+        with h5py.File(partial_file, 'w') as output_file:
+            dset1 = output_file.create_dataset('response_matrix', shape=(numrows, numcols_out), dtype=dset.dtype, 
+                                               chunks=(min(chunk_rows, numrows), numcols_out))
+            dset3 = output_file.create_dataset('row_nnz', shape=(numrows,), dtype=np.int64)
+            col_nnz = np.zeros(numcols_out, dtype=np.int64)
+            for start_row in range(0, numrows, block_rows):
+                block = np.add.reduceat(dset[start_row:start_row + block_rows][:, order], children, axis=1)
+                dset1[start_row:start_row + block.shape[0]] = block
+                dset3[start_row:start_row + block.shape[0]] = np.count_nonzero(block, axis=1)
+                col_nnz += np.count_nonzero(block, axis=0)
+            output_file.create_dataset('response_vector', data=np.add.reduceat(input_file['response_vector'][:][order], children))
+            output_file.create_dataset('col_nnz', data=col_nnz)
+            dset5 = output_file.create_dataset('parent_pixel', data=parent.astype(np.int64))
+            dset5.attrs['nside'] = nside_out
+            dset5.attrs['input_nside'] = nside_in
+            print(dset1.shape)
+        CommitFile(partial_file, downgraded_file)
+
+    return 0
+
+def main(max_workers=None, verify_checksums=False):
+
+    # A run that was interrupted leaves its marker behind. The next run then 
+    # verifies the checksums of all existing files.
+    global VERIFY_CHECKSUMS
+    marker = DATA_DIR / 'preprocessing.running'
+    if marker.is_file():
+        print('The previous run was interrupted. Verifying the checksums of the existing files.')
+    VERIFY_CHECKSUMS = verify_checksums or marker.is_file()
+    marker.touch()
 
     status = FileCheck()
-    status = Derived_FilesCheck()
-    status = FormattedResponse_FilesCheck()
+
+    # The response does not depend on the binned files, so it is flattened 
+    # in one process of the pool while the others bin the sources
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=SetVerifyChecksums, initargs=(VERIFY_CHECKSUMS,)) as pool:
+        response = pool.submit(FormattedResponse_FilesCheck)
+        status = Derived_FilesCheck(pool=pool)
+        status = response.result()
+
+    marker.unlink()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,34 @@
+import numpy as np
+
+'''
+Writer of the CSR layout of the flattened response ('response_matrix_csr'), 
+shared by datapreprocessing.py and the synthetic problems of benchmark.py. 
+It only needs numpy and h5py, so that the benchmark does not depend on 
+cosipy. RLparallel.py reads the layout with read_sparse_rows.
+'''
+
+def CreateSparseResponse(output_file, shape, dtype):
+    # Create the group 'response_matrix_csr' holding the flattened response 
+    # matrix in compressed sparse row (CSR) layout. Row i occupies 
+    # indices/data[indptr[i]:indptr[i+1]], so that RLparallel.py can read 
+    # a contiguous row slab. Rows are appended with AppendSparseRows.
+    numrows, numcols = shape
+    group = output_file.create_group('response_matrix_csr')
+    group.attrs['shape'] = (numrows, numcols)
+    indptr = group.create_dataset('indptr', shape=(numrows + 1,), dtype=np.int64)
+    indptr[0] = 0
+    group.create_dataset('indices', shape=(0,), maxshape=(None,), chunks=(1 << 20,), dtype=np.int32)
+    group.create_dataset('data', shape=(0,), maxshape=(None,), chunks=(1 << 20,), dtype=dtype)
+    return group
+
+def AppendSparseRows(group, start_row, block, nnz):
+    # Append the dense rows block, starting at start_row, to a CSR group 
+    # that already holds nnz nonzeros. Rows must be appended in order. 
+    # Returns the new number of nonzeros.
+    rows, cols = np.nonzero(block)                  # Row-major order
+    group['indptr'][start_row + 1:start_row + 1 + block.shape[0]] = nnz + np.cumsum(np.bincount(rows, minlength=block.shape[0]))
+    group['indices'].resize((nnz + rows.size,))
+    group['data'].resize((nnz + rows.size,))
+    group['indices'][nnz:] = cols
+    group['data'][nnz:] = block[rows, cols]
+    return nnz + rows.size
@@ -0,0 +1,63 @@
+import h5py
+import numpy as np
+import pytest
+
+import benchmark
+import RLparallel as rl
+
+NUMROWS, NUMCOLS, MAXITER = 400, 32, 10
+
+'''
+Synthetic problem of benchmark.py in the given response format
+'''
+def synthetic_problem(workdir, response_format):
+    return benchmark.generate_synthetic_problem(workdir, NUMROWS, NUMCOLS, density=0.2, response_format=response_format, 
+                                                block_rows=128)
+
+'''
+Plain NumPy RL loop on the full response, as in toymodel/
+'''
+def reference_rl(workdir, response_format):
+    with h5py.File(workdir / benchmark.RESPONSE_FILE, 'r') as f:
+        if response_format == 'csr':
+            group = f['response_matrix_csr']
+            indptr, indices, data = group['indptr'][:], group['indices'][:], group['data'][:]
+            R = np.zeros((NUMROWS, NUMCOLS))
+            R[np.repeat(np.arange(NUMROWS), np.diff(indptr)), indices] = data
+        else:
+            R = f['response_matrix'][:]
+    with h5py.File(workdir / benchmark.SIGNAL_FILE, 'r') as f:
+        signal = f['contents'][:]
+    with h5py.File(workdir / benchmark.BKG_FILE, 'r') as f:
+        bkg = f['contents'][:]
+    d = signal + bkg
+    Rj = R.sum(axis=0)
+    M = np.ones(NUMCOLS) * 1e-4
+    for iteration in range(MAXITER):
+        epsilon = R @ M + bkg
+        C = R.T @ (d / epsilon)
+        M = M + (C / Rj - 1) * M
+    return M
+
+def configure_solver(monkeypatch, workdir, response_format, backprojection, backend):
+    settings = {'NUMROWS': None, 'NUMCOLS': None, 'MAXITER': MAXITER, 'DATA_DIR': workdir, 'BASE_DIR': workdir, 
+                'RESPONSE_FILE': benchmark.RESPONSE_FILE, 'RESPONSE_FORMAT': response_format, 
+                'DATASETS': [([benchmark.SIGNAL_FILE], benchmark.BKG_FILE)], 'BACKPROJECTION': backprojection, 
+                'BACKEND': backend, 'NUM_PROCESSES': 3, 'OUTPUT_FILE': None, 'RUN_REPORT': None}
+    for name, value in settings.items():
+        monkeypatch.setattr(rl, name, value)
+
+# RESPONSE_FORMAT = 'csr' requires BACKPROJECTION = 'reduce'
+@pytest.mark.parametrize('backend', ['numpy', 'multiprocessing'])
+@pytest.mark.parametrize('response_format, backprojection', [('dense', 'reduce'), ('dense', 'transpose'), ('csr', 'reduce')])
+def test_backend_matches_reference(tmp_path, response_format, backprojection, backend, monkeypatch):
+    workdir = synthetic_problem(tmp_path, response_format)
+    configure_solver(monkeypatch, workdir, response_format, backprojection, backend)
+    M = rl.run()
+    np.testing.assert_allclose(M[:, 0], reference_rl(workdir, response_format), rtol=1e-10, atol=1e-14)
+
+def test_csr_transpose_is_rejected(tmp_path, monkeypatch):
+    workdir = synthetic_problem(tmp_path, 'csr')
+    configure_solver(monkeypatch, workdir, 'csr', 'transpose', 'numpy')
+    with pytest.raises(ValueError):
+        rl.run()